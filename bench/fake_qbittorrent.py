@@ -0,0 +1,228 @@
+# Simulador local da WebUI do qBittorrent, para medir o monitor sem um qBit de verdade.
+#
+# Uso isolado:
+#   python bench/fake_qbittorrent.py --port 8082 --torrents 1000
+# e no .env do bot:
+#   QB_HOST=http://127.0.0.1:8082
+#
+# Gera uma frota sintética de torrents e a faz evoluir a cada consulta ao sync/maindata,
+# respondendo com deltas por rid como o qBit real. As estatísticas ficam em /__stats__.
+import argparse
+import json
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+# Campos alterados a cada passo da simulação; só eles vão nos deltas
+MUTABLE_FIELDS = ("state", "progress", "downloaded", "dlspeed", "upspeed", "eta", "uploaded", "ratio", "completion_on")
+
+
+class FakeQBittorrentServer:
+    def __init__(self, host="127.0.0.1", port=0, torrents=10, churn=0.05, seed=0, latency=0.0):
+        self.churn = churn
+        self.latency = latency
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = Counter()
+        self.bytes_sent = 0
+        self.rid = 1
+        self.torrents = {}
+        self.changed_at = {}
+        self.removed_at = {}
+        for index in range(torrents):
+            self._add_torrent(index)
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def stats(self):
+        with self.lock:
+            return {"calls": dict(self.calls), "bytes_sent": self.bytes_sent, "rid": self.rid,
+                    "torrents": len(self.torrents)}
+
+    def _add_torrent(self, index):
+        # Mistura de downloads, seeds ativos e seeds parados, parecida com um seedbox real
+        torrent_hash = f"{index:040x}"
+        size = self.random.randint(50, 20000) * 1024 ** 2
+        kind = self.random.random()
+        progress = 1.0 if kind >= 0.3 else self.random.random()
+        if progress < 1.0:
+            state = "downloading"
+        else:
+            state = "uploading" if kind < 0.5 else "stalledUP"
+        self.torrents[torrent_hash] = {
+            "hash": torrent_hash, "name": f"Synthetic Torrent {index:05d}", "state": state,
+            "progress": progress, "downloaded": int(size * progress), "total_size": size, "size": size,
+            "dlspeed": self.random.randint(1, 20) * 1024 ** 2 if state == "downloading" else 0,
+            "upspeed": self.random.randint(1, 5) * 1024 ** 2 if state == "uploading" else 0,
+            "eta": 3600 if state == "downloading" else 8640000, "time_active": self.random.randint(60, 10 ** 6),
+            "tags": self.random.choice(["", "movies", "series", "music"]), "category": "",
+            "ratio": round(self.random.random() * 3, 3), "uploaded": 0, "added_on": int(time.time()) - 86400,
+            # Os já concluídos terminaram antes de o simulador subir, como a biblioteca de um qBit real
+            "completion_on": int(time.time()) - 3600 if progress >= 1.0 else -1,
+        }
+        self.changed_at[torrent_hash] = self.rid
+
+    def step(self):
+        # Avança a simulação: uma fração dos torrents muda de estado ou de velocidade
+        self.rid += 1
+        count = max(1, int(len(self.torrents) * self.churn)) if self.torrents else 0
+        for torrent_hash in self.random.sample(list(self.torrents), count):
+            torrent = self.torrents[torrent_hash]
+            if torrent["state"] == "downloading":
+                torrent["progress"] = min(1.0, torrent["progress"] + self.random.uniform(0.01, 0.2))
+                torrent["downloaded"] = int(torrent["total_size"] * torrent["progress"])
+                torrent["dlspeed"] = self.random.randint(1, 20) * 1024 ** 2
+                torrent["eta"] = int((1 - torrent["progress"]) * 3600)
+                if torrent["progress"] >= 1.0:
+                    torrent.update(state="stalledUP", dlspeed=0, eta=8640000, completion_on=int(time.time()))
+            else:
+                active = self.random.random() < 0.5
+                torrent["state"] = "uploading" if active else "stalledUP"
+                torrent["upspeed"] = self.random.randint(1, 5) * 1024 ** 2 if active else 0
+                torrent["uploaded"] += torrent["upspeed"]
+                torrent["ratio"] = round(torrent["uploaded"] / torrent["total_size"], 3)
+            self.changed_at[torrent_hash] = self.rid
+
+    def maindata(self, rid):
+        with self.lock:
+            self.step()
+            server_state = {"free_space_on_disk": 500 * 1024 ** 3, "dl_info_speed": 0, "up_info_speed": 0}
+            if rid <= 0 or rid > self.rid:
+                return {"rid": self.rid, "full_update": True, "torrents": dict(self.torrents),
+                        "server_state": server_state}
+            torrents = {
+                torrent_hash: {field: self.torrents[torrent_hash][field] for field in MUTABLE_FIELDS}
+                for torrent_hash, changed in self.changed_at.items() if changed > rid
+            }
+            removed = [torrent_hash for torrent_hash, removed in self.removed_at.items() if removed > rid]
+            return {"rid": self.rid, "torrents": torrents, "torrents_removed": removed, "server_state": server_state}
+
+    def apply_action(self, action, fields):
+        # Ações em lote recebem os hashes separados por "|", como no qBit real
+        hashes = fields.get("hashes", "")
+        targets = list(self.torrents) if hashes == "all" else [h for h in hashes.split("|") if h in self.torrents]
+        with self.lock:
+            self.rid += 1
+            for torrent_hash in targets:
+                if action == "delete":
+                    del self.torrents[torrent_hash]
+                    del self.changed_at[torrent_hash]
+                    self.removed_at[torrent_hash] = self.rid
+                    continue
+                torrent = self.torrents[torrent_hash]
+                if action in ("stop", "pause"):
+                    torrent.update(state="stoppedUP" if torrent["progress"] >= 1.0 else "stoppedDL",
+                                   dlspeed=0, upspeed=0)
+                elif action in ("start", "resume"):
+                    torrent["state"] = "stalledUP" if torrent["progress"] >= 1.0 else "downloading"
+                elif action == "recheck":
+                    torrent["state"] = "checkingUP" if torrent["progress"] >= 1.0 else "checkingDL"
+                self.changed_at[torrent_hash] = self.rid
+        return "Ok."
+
+    def handle(self, path, fields):
+        with self.lock:
+            self.calls[path] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+        if path == "auth/login":
+            return 200, "Ok."
+        if path == "auth/logout":
+            return 200, ""
+        if path == "app/version":
+            return 200, "v5.0.0"
+        if path == "app/webapiVersion":
+            return 200, "2.11.0"
+        if path == "app/buildInfo":
+            return 200, {"qt": "6.7.0", "libtorrent": "2.0.10", "boost": "1.84", "openssl": "3.2", "bitness": 64}
+        if path == "sync/maindata":
+            return 200, self.maindata(int(fields.get("rid") or 0))
+        if path == "torrents/info":
+            with self.lock:
+                return 200, list(self.torrents.values())
+        action = path.rpartition("/")[2]
+        if path.startswith("torrents/") and action in ("stop", "start", "pause", "resume", "recheck", "delete"):
+            return 200, self.apply_action(action, fields)
+        if path in ("torrents/setDownloadLimit", "torrents/setUploadLimit"):
+            return 200, ""
+        return 404, "Not Found"
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                if self.path == "/__stats__":
+                    self._reply(200, fake.stats())
+                    return
+                self._dispatch(b"")
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                self._dispatch(self.rfile.read(length))
+
+            def _dispatch(self, body):
+                url = urlsplit(self.path)
+                fields = dict(parse_qsl(url.query))
+                fields.update(parse_qsl(body.decode(errors="replace")))
+                path = url.path.partition("/api/v2/")[2].rstrip("/")
+                status, payload = fake.handle(path, fields)
+                self._reply(status, payload, login=path == "auth/login")
+
+            def _reply(self, status, payload, login=False):
+                if isinstance(payload, str):
+                    data, content_type = payload.encode(), "text/plain; charset=UTF-8"
+                else:
+                    data, content_type = json.dumps(payload).encode(), "application/json"
+                with fake.lock:
+                    fake.bytes_sent += len(data)
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                if login:
+                    self.send_header("Set-Cookie", "SID=fake; HttpOnly; path=/")
+                self.end_headers()
+                self.wfile.write(data)
+
+        return Handler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulador local da WebUI do qBittorrent")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8082)
+    parser.add_argument("--torrents", type=int, default=10)
+    parser.add_argument("--churn", type=float, default=0.05, help="fração dos torrents alterada por consulta")
+    parser.add_argument("--latency", type=float, default=0.0, help="atraso artificial por requisição (s)")
+    args = parser.parse_args()
+
+    server = FakeQBittorrentServer(args.host, args.port, args.torrents, args.churn, latency=args.latency)
+    print(f"WebUI do qBittorrent simulada em {server.url} com {args.torrents} torrents")
+    try:
+        server.server.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
@@ -0,0 +1,263 @@
+# Simulador local da Bot API do Telegram, para rodar o bot e os benchmarks sem rede.
+#
+# Uso isolado:
+#   python bench/fake_telegram.py --port 8081
+# e no .env do bot:
+#   TELEGRAM_API_BASE_URL=http://127.0.0.1:8081
+#
+# Implementa só os métodos que o bot usa. Os uploads são lidos em blocos e descartados, então
+# o simulador não guarda partes grandes em memória. As estatísticas ficam em /__stats__.
+#
+# Para testar o modo webhook, o simulador guarda a URL e o segredo do setWebhook e entrega
+# atualizações nela com push_update() ou com um POST do JSON da atualização em /__push_update__.
+import argparse
+import json
+import re
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+READ_CHUNK = 1024 * 1024
+FIELD_WINDOW = 64 * 1024
+
+
+class FakeTelegramServer:
+    def __init__(self, host="127.0.0.1", port=0, flood_every=0, retry_after=1, latency=0.0):
+        self.flood_every = flood_every
+        self.retry_after = retry_after
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.calls = Counter()
+        self.bytes_received = 0
+        self.request_times = []
+        self.documents = []
+        self.next_message_id = 1
+        self.next_update_id = 1
+        self.webhook_url = ""
+        self.webhook_secret = ""
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "calls": dict(self.calls),
+                "bytes_received": self.bytes_received,
+                "requests": len(self.request_times),
+                "documents": len(self.documents),
+                "webhook_url": self.webhook_url,
+            }
+
+    def requests_per_minute(self, since=None):
+        with self.lock:
+            times = [t for t in self.request_times if since is None or t >= since]
+        if len(times) < 2:
+            return float(len(times))
+        return len(times) / max(times[-1] - times[0], 1e-6) * 60
+
+    def _message(self, chat_id, **extra):
+        with self.lock:
+            message_id = self.next_message_id
+            self.next_message_id += 1
+        chat_id = int(chat_id or 0)
+        message = {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "supergroup" if chat_id < 0 else "private"},
+        }
+        message.update(extra)
+        return message
+
+    def handle(self, method, fields, size):
+        with self.lock:
+            self.calls[method] += 1
+            self.bytes_received += size
+            self.request_times.append(time.time())
+            flood = self.flood_every and sum(self.calls.values()) % self.flood_every == 0
+        if self.latency:
+            time.sleep(self.latency)
+        if flood and method not in ("getMe", "getUpdates"):
+            return 429, {
+                "ok": False, "error_code": 429, "description": "Too Many Requests: retry later",
+                "parameters": {"retry_after": self.retry_after},
+            }
+
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "fake", "username": "fake_bot",
+                      "can_join_groups": True, "can_read_all_group_messages": False,
+                      "supports_inline_queries": False}
+        elif method == "getUpdates":
+            time.sleep(min(float(fields.get("timeout") or 0), 1.0))
+            result = []
+        elif method in ("sendMessage", "editMessageText"):
+            result = self._message(fields.get("chat_id"), text=fields.get("text", ""))
+            if method == "editMessageText":
+                result["message_id"] = int(fields.get("message_id") or 0)
+        elif method == "sendDocument":
+            document_id = f"fake-{len(self.documents) + 1}"
+            document = {"file_id": document_id, "file_unique_id": document_id,
+                        "file_name": fields.get("file_name", "document"), "file_size": size}
+            with self.lock:
+                self.documents.append(document)
+            result = self._message(fields.get("chat_id"), document=document, caption=fields.get("caption", ""))
+        elif method == "setWebhook":
+            with self.lock:
+                self.webhook_url = fields.get("url", "")
+                self.webhook_secret = fields.get("secret_token", "")
+            result = True
+        elif method == "deleteWebhook":
+            with self.lock:
+                self.webhook_url = self.webhook_secret = ""
+            result = True
+        elif method in ("deleteMessage", "answerCallbackQuery", "setMyCommands", "close", "logOut"):
+            result = True
+        elif method == "getWebhookInfo":
+            result = {"url": self.webhook_url, "has_custom_certificate": False, "pending_update_count": 0}
+        else:
+            return 404, {"ok": False, "error_code": 404, "description": "Not Found: method not found"}
+        return 200, {"ok": True, "result": result}
+
+    def push_update(self, update, secret=None):
+        # Entrega a atualização no webhook registrado, como o Telegram faria; devolve o status HTTP
+        with self.lock:
+            url, token = self.webhook_url, self.webhook_secret if secret is None else secret
+            update = dict(update)
+            update.setdefault("update_id", self.next_update_id)
+            self.next_update_id = update["update_id"] + 1
+        if not url:
+            raise RuntimeError("nenhum webhook registrado")
+        request = urllib.request.Request(url, data=json.dumps(update).encode(), method="POST")
+        request.add_header("Content-Type", "application/json")
+        if token:
+            request.add_header("X-Telegram-Bot-Api-Secret-Token", token)
+        try:
+            with urllib.request.urlopen(request, timeout=10) as response:
+                return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+    def command_update(self, text, chat_id=1, user_id=1):
+        # Atualização de mensagem com um comando, no formato da Bot API
+        return {"message": {
+            "message_id": 1, "date": int(time.time()), "text": text,
+            "chat": {"id": chat_id, "type": "supergroup" if chat_id < 0 else "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "bench"},
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}],
+        }}
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                if self.path == "/__stats__":
+                    self._reply(200, fake.stats())
+                    return
+                self._dispatch(b"")
+
+            def do_POST(self):
+                if self.path == "/__push_update__":
+                    length = int(self.headers.get("Content-Length") or 0)
+                    try:
+                        status = fake.push_update(json.loads(self.rfile.read(length) or b"{}"))
+                    except RuntimeError as e:
+                        self._reply(409, {"ok": False, "description": str(e)})
+                        return
+                    self._reply(200, {"webhook_status": status})
+                    return
+                self._dispatch(None)
+
+            def _dispatch(self, body):
+                method = self.path.rstrip("/").rsplit("/", 1)[-1]
+                fields, size = self._read_fields(body)
+                status, payload = fake.handle(method, fields, size)
+                self._reply(status, payload)
+
+            def _read_fields(self, body):
+                # Lê o corpo em blocos; só o começo e o fim são guardados para extrair os campos
+                length = int(self.headers.get("Content-Length") or 0)
+                content_type = self.headers.get("Content-Type", "")
+                head, tail, remaining = b"", b"", length
+                while body is None and remaining:
+                    chunk = self.rfile.read(min(READ_CHUNK, remaining))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                    if len(head) < FIELD_WINDOW:
+                        head += chunk[:FIELD_WINDOW - len(head)]
+                    tail = (tail + chunk)[-FIELD_WINDOW:]
+                body = body if body is not None else head
+                if content_type.startswith("multipart/form-data"):
+                    return parse_multipart_fields(head + b"\r\n" + tail), length
+                if content_type.startswith("application/json"):
+                    return json.loads(body or b"{}"), length
+                fields = dict(parse_qsl(body.decode(errors="replace")))
+                fields.update(parse_qsl(self.path.partition("?")[2]))
+                return fields, length
+
+            def _reply(self, status, payload):
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        return Handler
+
+
+FIELD_RE = re.compile(rb'name="([^"]+)"(?:; filename="([^"]*)")?\r\n(?:[^\r\n]+\r\n)*\r\n')
+
+
+def parse_multipart_fields(data):
+    # Extrai os campos de texto e o nome do arquivo, ignorando o conteúdo do upload
+    fields = {}
+    for match in FIELD_RE.finditer(data):
+        name, filename = match.group(1).decode(), match.group(2)
+        if filename is not None:
+            fields["file_name"] = filename.decode(errors="replace")
+            continue
+        value = data[match.end():data.find(b"\r\n--", match.end())]
+        fields[name] = value.decode(errors="replace")
+    return fields
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulador local da Bot API do Telegram")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--flood-every", type=int, default=0, help="responde 429 a cada N requisições")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--latency", type=float, default=0.0, help="atraso artificial por requisição (s)")
+    args = parser.parse_args()
+
+    server = FakeTelegramServer(args.host, args.port, args.flood_every, args.retry_after, args.latency)
+    print(f"Bot API simulada em {server.url}")
+    try:
+        server.server.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
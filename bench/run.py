@@ -0,0 +1,246 @@
+# Benchmark do bot contra os simuladores locais do qBittorrent e da Bot API.
+#
+# Uso:
+#   python bench/run.py                          # frotas de 10, 1k e 10k torrents e payloads de 0.5 e 2 GB
+#   python bench/run.py --fleets 10,1000 --payloads-gb 0.1 --ticks 10
+#   python bench/run.py --json resultados.json   # também grava o resultado bruto
+#
+# Cada cenário roda em um subprocesso próprio, para o estado global do bot começar limpo e o
+# pico de RSS medido ser só daquele cenário.
+import argparse
+import asyncio
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from fake_qbittorrent import FakeQBittorrentServer  # noqa: E402
+from fake_telegram import FakeTelegramServer  # noqa: E402
+
+TOKEN = "123456:bench"
+WRITE_BLOCK = 16 * 1024 ** 2
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def peak_rss_mb():
+    # No Linux o ru_maxrss vem em KB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def configure_environment(workdir, telegram, qbittorrent, display_mode):
+    # O bot lê a configuração na importação, então o ambiente é montado antes do import
+    os.environ.update({
+        "TELEGRAM_BOT_TOKEN": TOKEN,
+        "TELEGRAM_CHAT_ID": "1000",
+        "TELEGRAM_FILE_CHAT_ID": "-1000",
+        "TELEGRAM_API_BASE_URL": telegram.url,
+        "DOWNLOADS_PATH": workdir,
+        "QB_HOST": qbittorrent.url if qbittorrent else "http://127.0.0.1:9",
+        "QB_USERNAME": "bench",
+        "QB_PASSWORD": "bench",
+        "STATE_DB_PATH": os.path.join(workdir, "bench_state.db"),
+        "UPLOAD_BACKEND": "botapi",
+        "DISPLAY_MODE": display_mode,
+        "LOG_LEVEL": "WARNING",
+        "METRICS_PORT": "0",
+    })
+    os.environ.pop("QB_INSTANCES", None)
+    sys.path.insert(0, ROOT_DIR)
+    import bot
+    return bot
+
+
+async def make_bot(bot_module, telegram):
+    from telegram import Bot
+
+    telegram_bot = Bot(TOKEN, base_url=f"{telegram.url}/bot", base_file_url=f"{telegram.url}/file/bot")
+    await telegram_bot.initialize()
+    return telegram_bot
+
+
+async def bench_monitor(args, workdir):
+    telegram = FakeTelegramServer().start()
+    qbittorrent = FakeQBittorrentServer(torrents=args.torrents, churn=args.churn).start()
+    bot = configure_environment(workdir, telegram, qbittorrent, args.display_mode)
+    context = type("BenchContext", (), {})()
+    context.bot = await make_bot(bot, telegram)
+
+    instance = bot.qb_instances["default"]
+    instance.qbt = qbt = bot.AsyncQBittorrent(qbittorrent.url, "bench", "bench")
+    await qbt.call("auth_log_in")
+
+    latencies, calls, sent = [], [], []
+    started = time.time()
+    for _ in range(args.ticks):
+        before = qbittorrent.stats()
+        tick_started = time.perf_counter()
+        await bot.run_monitor_tick(context, instance, qbt)
+        latencies.append(time.perf_counter() - tick_started)
+        after = qbittorrent.stats()
+        calls.append(sum(after["calls"].values()) - sum(before["calls"].values()))
+        sent.append(after["bytes_sent"] - before["bytes_sent"])
+        # Deixa a fila do Telegram trabalhar entre os ciclos, como no intervalo real do monitor
+        await asyncio.sleep(args.interval)
+    elapsed = time.time() - started
+
+    telegram_stats = telegram.stats()
+    qbt.close()
+    await context.bot.shutdown()
+    telegram.stop()
+    qbittorrent.stop()
+    return {
+        "scenario": f"monitor-{args.torrents}",
+        "torrents": args.torrents,
+        "ticks": args.ticks,
+        "tick_p50_ms": percentile(latencies, 0.50) * 1000,
+        "tick_p95_ms": percentile(latencies, 0.95) * 1000,
+        "tick_p99_ms": percentile(latencies, 0.99) * 1000,
+        "tick_max_ms": max(latencies) * 1000,
+        "full_sync_ms": latencies[0] * 1000,
+        "qbt_calls_per_tick": statistics.mean(calls),
+        "qbt_bytes_first_tick": sent[0],
+        "qbt_bytes_per_tick": statistics.mean(sent[1:] or sent),
+        "telegram_requests": telegram_stats["requests"],
+        "telegram_rpm": telegram_stats["requests"] / elapsed * 60,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def write_payload(directory, size):
+    # Dados aleatórios: o pior caso para a compressão e o caso comum para vídeo
+    os.makedirs(directory, exist_ok=True)
+    remaining, index = size, 0
+    while remaining > 0:
+        file_size = min(remaining, 1024 ** 3)
+        with open(os.path.join(directory, f"file{index:03d}.bin"), "wb") as output:
+            written = 0
+            while written < file_size:
+                block = os.urandom(min(WRITE_BLOCK, file_size - written))
+                output.write(block)
+                written += len(block)
+        remaining -= file_size
+        index += 1
+
+
+async def bench_upload(args, workdir):
+    telegram = FakeTelegramServer(latency=args.telegram_latency).start()
+    bot = configure_environment(workdir, telegram, None, "torrent")
+    telegram_bot = await make_bot(bot, telegram)
+
+    size = int(args.payload_gb * 1024 ** 3)
+    name = f"Bench Payload {args.payload_gb}GB"
+    write_payload(os.path.join(workdir, name), size)
+
+    # Só a compactação: partes geradas e descartadas sem envio
+    started = time.perf_counter()
+    archived = 0
+    async for part in bot.stream_archive_parts(os.path.join(workdir, name), name.replace(" ", "_")):
+        archived += part.size
+        part.file.close()
+    archive_seconds = time.perf_counter() - started
+
+    # Compactação e envio de ponta a ponta contra a Bot API simulada
+    key = "default:" + "f" * 40
+    bot.state_store.claim_upload(key, name, bot.ARCHIVE_COMPRESSION, bot.ARCHIVE_PART_SIZE, size)
+    started = time.perf_counter()
+    await bot.send_completed_torrent_parts(telegram_bot, key)
+    upload_seconds = time.perf_counter() - started
+
+    telegram_stats = telegram.stats()
+    status = bot.state_store.get_upload(key).status
+    await telegram_bot.shutdown()
+    telegram.stop()
+    return {
+        "scenario": f"upload-{args.payload_gb}GB",
+        "payload_bytes": size,
+        "archive_bytes": archived,
+        "compression": bot.ARCHIVE_COMPRESSION,
+        "archive_mb_s": size / 1024 ** 2 / archive_seconds,
+        "upload_mb_s": size / 1024 ** 2 / upload_seconds,
+        "upload_status": status,
+        "documents": telegram_stats["documents"],
+        "telegram_bytes": telegram_stats["bytes_received"],
+        "telegram_requests": telegram_stats["requests"],
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def run_scenario(args):
+    with tempfile.TemporaryDirectory(prefix="bench-", dir=args.workdir) as workdir:
+        bench = bench_monitor if args.scenario == "monitor" else bench_upload
+        result = asyncio.run(bench(args, workdir))
+    print(json.dumps(result))
+
+
+def run_child(args, scenario, **options):
+    command = [sys.executable, os.path.abspath(__file__), "--scenario", scenario,
+               "--ticks", str(args.ticks), "--interval", str(args.interval), "--churn", str(args.churn),
+               "--display-mode", args.display_mode, "--telegram-latency", str(args.telegram_latency)]
+    if args.workdir:
+        command += ["--workdir", args.workdir]
+    for option, value in options.items():
+        command += [f"--{option.replace('_', '-')}", str(value)]
+    output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def print_report(results):
+    for result in results:
+        print(f"\n== {result['scenario']} ==")
+        for key, value in result.items():
+            if key != "scenario":
+                print(f"  {key:22} {value:.2f}" if isinstance(value, float) else f"  {key:22} {value}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark do monitor e do envio de torrents")
+    parser.add_argument("--fleets", default="10,1000,10000", help="tamanhos de frota, separados por vírgula")
+    parser.add_argument("--payloads-gb", default="0.5,2", help="tamanhos de payload em GB, separados por vírgula")
+    parser.add_argument("--ticks", type=int, default=20)
+    parser.add_argument("--interval", type=float, default=1.0, help="pausa entre ciclos do monitor (s)")
+    parser.add_argument("--churn", type=float, default=0.05, help="fração dos torrents alterada por ciclo")
+    parser.add_argument("--display-mode", default="torrent", choices=["torrent", "dashboard"])
+    parser.add_argument("--telegram-latency", type=float, default=0.0, help="atraso por requisição da Bot API (s)")
+    parser.add_argument("--workdir", default=None, help="onde criar os payloads (padrão: pasta temporária)")
+    parser.add_argument("--json", help="grava os resultados brutos neste arquivo")
+    # Usados internamente para rodar um cenário no subprocesso
+    parser.add_argument("--scenario", choices=["monitor", "upload"], help=argparse.SUPPRESS)
+    parser.add_argument("--torrents", type=int, default=10, help=argparse.SUPPRESS)
+    parser.add_argument("--payload-gb", type=float, default=0.5, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.scenario:
+        run_scenario(args)
+        return
+
+    results = []
+    for torrents in (int(value) for value in args.fleets.split(",") if value):
+        print(f"Rodando monitor com {torrents} torrents...", file=sys.stderr)
+        results.append(run_child(args, "monitor", torrents=torrents))
+    for payload in (float(value) for value in args.payloads_gb.split(",") if value):
+        print(f"Rodando envio de {payload} GB...", file=sys.stderr)
+        results.append(run_child(args, "upload", payload_gb=payload))
+
+    print_report(results)
+    if args.json:
+        with open(args.json, "w") as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
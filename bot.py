@@ -1,14 +1,50 @@
 import ssl
-from telegram import Update, InputFile
-from telegram.ext import Application, CommandHandler, CallbackContext
+import asyncio
+import atexit
+import bisect
+import fnmatch
+import cProfile
+import hashlib
+import heapq
+import hmac
+import json
+import logging
+import logging.handlers
+import queue
+import re
+import sqlite3
+from telegram import Update, InputFile, InlineKeyboardButton, InlineKeyboardMarkup, Message
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
+from telegram.ext import Application, CommandHandler, CallbackContext, CallbackQueryHandler
 import os
 import platform
 import time
+import httpx
 import psutil
+import secrets
 import shutil
-import subprocess
-import glob
+import pstats
+import io
+import sys
+import gzip
+import tarfile
+import tempfile
+import threading
+import uuid
+import traceback
+import zlib
+import contextvars
+import pyrogram
+import zstandard
+from collections import defaultdict, deque, namedtuple
+from contextlib import asynccontextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from types import SimpleNamespace
+from urllib.parse import parse_qsl, urlsplit
 from qbittorrentapi import Client, TorrentState
+from pyrogram.errors import FloodWait
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -22,10 +58,472 @@ DOWNLOADS_PATH = os.getenv("DOWNLOADS_PATH")
 QB_USERNAME = os.getenv("QB_USERNAME")
 QB_PASSWORD = os.getenv("QB_PASSWORD")
 QB_HOST = os.getenv("QB_HOST")
+QB_TIMEOUT = float(os.getenv("QB_TIMEOUT", "10"))
+QB_POOL_SIZE = int(os.getenv("QB_POOL_SIZE", "4"))
 
-# Armazena os IDs das mensagens dos torrents e últimos tempos de seeding
-torrent_message_ids = {}
-torrent_last_uploaded = {}
+# Frota de instâncias do qBit: QB_INSTANCES=nome1,nome2 e, para cada nome, QB_<NOME>_HOST,
+# QB_<NOME>_USERNAME, QB_<NOME>_PASSWORD, QB_<NOME>_DOWNLOADS_PATH e QB_<NOME>_TIMEOUT.
+# Usuário, senha, pasta e timeout caem nos valores globais quando não definidos. Sem
+# QB_INSTANCES, QB_HOST vira a única instância, com o nome "default".
+QBInstanceConfig = namedtuple("QBInstanceConfig", ["name", "host", "username", "password", "downloads_path", "timeout"])
+
+def load_qb_instances():
+    names = [name.strip() for name in os.getenv("QB_INSTANCES", "").split(",") if name.strip()]
+    if not names:
+        return [QBInstanceConfig("default", QB_HOST, QB_USERNAME, QB_PASSWORD, DOWNLOADS_PATH, QB_TIMEOUT)]
+    configs = []
+    for name in names:
+        # O nome entra nas chaves "instância:hash", então não pode ter ":"
+        name = name.replace(":", "_")
+        prefix = "QB_" + re.sub(r"\W", "_", name).upper() + "_"
+        configs.append(QBInstanceConfig(
+            name=name,
+            host=os.getenv(prefix + "HOST"),
+            username=os.getenv(prefix + "USERNAME", QB_USERNAME),
+            password=os.getenv(prefix + "PASSWORD", QB_PASSWORD),
+            downloads_path=os.getenv(prefix + "DOWNLOADS_PATH", DOWNLOADS_PATH),
+            timeout=float(os.getenv(prefix + "TIMEOUT") or QB_TIMEOUT),
+        ))
+    return configs
+
+QB_INSTANCES = load_qb_instances()
+
+# Limiares para uma mudança de status valer uma edição no Telegram
+RENDER_PROGRESS_DELTA = float(os.getenv("RENDER_PROGRESS_DELTA", "0.5"))  # pontos percentuais
+RENDER_SPEED_DELTA = float(os.getenv("RENDER_SPEED_DELTA", "0.5"))  # MB/s
+RENDER_MAX_AGE = float(os.getenv("RENDER_MAX_AGE", "60"))  # segundos até forçar uma edição
+
+# Intervalo adaptativo do monitor (segundos): rápido com downloads recebendo dados, normal
+# com seeds ativos ou verificações em andamento, recuando exponencialmente até o máximo quando
+# está tudo parado, na fila ou travado
+MONITOR_MIN_INTERVAL = float(os.getenv("MONITOR_MIN_INTERVAL", "3"))
+MONITOR_INTERVAL = float(os.getenv("MONITOR_INTERVAL", "7"))
+MONITOR_MAX_INTERVAL = float(os.getenv("MONITOR_MAX_INTERVAL", "120"))
+
+# De quanto em quanto tempo cada classe de torrent é reprocessada (segundos)
+REFRESH_INTERVALS = {
+    "active": 0.0,
+    "seeding": float(os.getenv("REFRESH_SEEDING_INTERVAL", "30")),
+    "idle": float(os.getenv("REFRESH_IDLE_INTERVAL", "300")),
+}
+
+# Exibição: uma mensagem por torrent ("torrent") ou painel paginado ("dashboard")
+DISPLAY_MODE = os.getenv("DISPLAY_MODE", "torrent").lower()
+DASHBOARD_MESSAGES = int(os.getenv("DASHBOARD_MESSAGES", "1"))
+DASHBOARD_PAGE_SIZE = int(os.getenv("DASHBOARD_PAGE_SIZE", "15"))
+DASHBOARD_SORT = os.getenv("DASHBOARD_SORT", "speed").lower()  # speed | eta | progress
+DASHBOARD_GROUP = os.getenv("DASHBOARD_GROUP", "state").lower()  # state | instance | tag | none
+DASHBOARD_NAME_WIDTH = 40
+DASHBOARD_KEY_PREFIX = "dashboard:"  # chave das mensagens do painel no banco
+
+# Limites de envio para o Telegram (mensagens por segundo)
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", "25"))
+TG_CHAT_RATE = float(os.getenv("TG_CHAT_RATE", "1"))
+TG_CHAT_BURST = int(os.getenv("TG_CHAT_BURST", "3"))
+TG_MAX_INFLIGHT = int(os.getenv("TG_MAX_INFLIGHT", "8"))
+TG_MAX_ATTEMPTS = int(os.getenv("TG_MAX_ATTEMPTS", "3"))
+
+# Backend de upload: a Bot API aceita arquivos de até 50MB; via MTProto (pyrogram + tgcrypto)
+# o limite é 2000MiB. No modo auto, o MTProto é usado quando API_ID e API_HASH estão definidos.
+UPLOAD_BACKEND = os.getenv("UPLOAD_BACKEND", "auto").lower()  # auto | botapi | mtproto
+TELEGRAM_API_ID = os.getenv("TELEGRAM_API_ID")
+TELEGRAM_API_HASH = os.getenv("TELEGRAM_API_HASH")
+TELEGRAM_API_BASE_URL = os.getenv("TELEGRAM_API_BASE_URL")
+USE_MTPROTO = UPLOAD_BACKEND == "mtproto" or (
+    UPLOAD_BACKEND == "auto" and bool(TELEGRAM_API_ID) and bool(TELEGRAM_API_HASH)
+)
+BOT_API_MAX_PART_SIZE = 50 * 1000 * 1000
+MTPROTO_MAX_PART_SIZE = 2000 * 1024 * 1024
+
+# Compactação e envio dos torrents concluídos
+ARCHIVE_PART_SIZE = min(
+    int(os.getenv("ARCHIVE_PART_SIZE_MB") or ("2000" if USE_MTPROTO else "50")) * 1000 * 1000,
+    MTPROTO_MAX_PART_SIZE if USE_MTPROTO else BOT_API_MAX_PART_SIZE,
+)
+ARCHIVE_MEMORY_LIMIT = int(os.getenv("ARCHIVE_MEMORY_LIMIT_MB", "64")) * 1024 * 1024
+ARCHIVE_QUEUE_DEPTH = int(os.getenv("ARCHIVE_QUEUE_DEPTH", "2"))
+# Volume onde as partes maiores que ARCHIVE_MEMORY_LIMIT são gravadas enquanto esperam o envio,
+# e quanto espaço livre deixar intocado nele
+STAGING_PATH = os.getenv("STAGING_PATH") or tempfile.gettempdir()
+STAGING_RESERVE = int(float(os.getenv("STAGING_RESERVE_MB", "1024")) * 1024 * 1024)
+STAGING_RECHECK = 30.0
+ARCHIVE_COMPRESSION = os.getenv("ARCHIVE_COMPRESSION", "auto").lower()  # store | gzip | zstd | auto
+ARCHIVE_MODES = ("store", "gzip", "zstd", "auto")
+ARCHIVE_COMPRESSION_LEVEL = int(os.getenv("ARCHIVE_COMPRESSION_LEVEL")) if os.getenv("ARCHIVE_COMPRESSION_LEVEL") else None
+ARCHIVE_THREADS = int(os.getenv("ARCHIVE_THREADS", str(os.cpu_count() or 1)))
+ARCHIVE_BLOCK_SIZE = 4 * 1024 * 1024
+ARCHIVE_ADAPTIVE_CHUNK = 512 * 1024
+ARCHIVE_SAMPLE_SIZE = 32 * 1024
+ARCHIVE_INCOMPRESSIBLE_RATIO = 0.95
+UPLOAD_TIMEOUT = float(os.getenv("UPLOAD_TIMEOUT", "300"))
+UPLOAD_BUFFER_SIZE = int(os.getenv("UPLOAD_BUFFER_KB", "256")) * 1024
+UPLOAD_CONCURRENCY = int(os.getenv("UPLOAD_CONCURRENCY", "3"))
+UPLOAD_RETRIES = int(os.getenv("UPLOAD_RETRIES", "5"))
+UPLOAD_WORKERS = int(os.getenv("UPLOAD_WORKERS", "1"))
+# Envios que falham voltam sozinhos para a fila, com espera dobrando a cada falha até o máximo (segundos)
+UPLOAD_RETRY_DELAY = float(os.getenv("UPLOAD_RETRY_DELAY", "60"))
+UPLOAD_RETRY_MAX_DELAY = float(os.getenv("UPLOAD_RETRY_MAX_DELAY", "3600"))
+# Depois de tantas tentativas, ou de um erro que não muda ao repetir, o envio fica "abandoned"
+# até um /start pedir de novo
+UPLOAD_RETRY_LIMIT = int(os.getenv("UPLOAD_RETRY_LIMIT", "8"))
+UPLOAD_PRIORITY = os.getenv("UPLOAD_PRIORITY", "size").lower()  # size | tag
+UPLOAD_PRIORITY_TAGS = [tag.strip() for tag in os.getenv("UPLOAD_PRIORITY_TAGS", "").split(",") if tag.strip()]
+
+# Deduplicação por conteúdo (opcional): arquivos a partir de DEDUPE_MIN_SIZE_MB são enviados
+# avulsos e indexados pelo digest, e conteúdo já enviado antes é reenviado pelo file_id
+UPLOAD_DEDUPE = os.getenv("UPLOAD_DEDUPE", "false").lower() in ("1", "true", "yes")
+DEDUPE_MIN_SIZE = int(float(os.getenv("DEDUPE_MIN_SIZE_MB", "8")) * 1024 * 1024)
+DEDUPE_HASH_WORKERS = int(os.getenv("DEDUPE_HASH_WORKERS", "4"))
+DEDUPE_READ_SIZE = 1024 * 1024
+
+# Como o bot recebe as atualizações do Telegram: long polling (padrão) ou webhook. No modo
+# webhook o bot escuta em WEBHOOK_LISTEN:WEBHOOK_PORT, normalmente atrás de um proxy reverso
+# que publica WEBHOOK_URL; WEBHOOK_CERT/WEBHOOK_KEY ativam o HTTPS no próprio bot. Sem
+# WEBHOOK_SECRET, um segredo aleatório é gerado a cada início (o webhook é registrado de novo).
+TELEGRAM_MODE = os.getenv("TELEGRAM_MODE", "polling").lower()  # polling | webhook
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram").strip("/")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+WEBHOOK_CERT = os.getenv("WEBHOOK_CERT") or None
+WEBHOOK_KEY = os.getenv("WEBHOOK_KEY") or None
+# Quantas atualizações são tratadas ao mesmo tempo, nos dois modos
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "8"))
+
+# Endpoint local que recebe o aviso de "torrent concluído" do qBit (veja notify_finished.py).
+# INGEST_PORT=0 desliga; com INGEST_TOKEN definido, o aviso precisa trazer o mesmo token.
+INGEST_ADDR = os.getenv("INGEST_ADDR", "127.0.0.1")
+INGEST_PORT = int(os.getenv("INGEST_PORT", "8765"))
+INGEST_TOKEN = os.getenv("INGEST_TOKEN", "")
+
+# Consultas ao snapshot do monitor (/top, /find, /tag): quantos torrents o /top lista sem N
+# e o máximo de linhas por resposta
+TOP_DEFAULT = 10
+QUERY_MAX_RESULTS = int(os.getenv("QUERY_MAX_RESULTS", "50"))
+
+# Usuários que podem usar os comandos administrativos. Sem a lista, o /profile vale para quem
+# estiver no chat configurado em TELEGRAM_CHAT_ID e o controle em lote (/pause, /delete...) fica
+# desligado.
+ADMIN_USER_IDS = {int(user_id) for user_id in os.getenv("ADMIN_USER_IDS", "").split(",") if user_id.strip()}
+
+# Perfilamento sob demanda: duração padrão e máxima da janela e o tempo a partir do qual o
+# loop de eventos é considerado travado (segundos)
+PROFILE_DEFAULT_SECONDS = 30
+PROFILE_MAX_SECONDS = int(os.getenv("PROFILE_MAX_SECONDS", "300"))
+LOOP_BLOCK_THRESHOLD = float(os.getenv("LOOP_BLOCK_THRESHOLD", "0.25"))
+
+# Banco local com o estado que precisa sobreviver a reinícios
+STATE_DB_PATH = os.getenv("STATE_DB_PATH", "bot_state.db")
+
+# Logs e endpoint de métricas no formato do Prometheus (METRICS_PORT=0 desliga)
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+METRICS_ADDR = os.getenv("METRICS_ADDR", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))
+
+# Os logs passam por uma fila: quem loga só enfileira o registro, e uma thread separada
+# formata e escreve, para o loop do monitor não esperar pelo terminal
+def setup_logging(level=LOG_LEVEL):
+    log_queue = queue.SimpleQueue()
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    root = logging.getLogger()
+    root.handlers[:] = [logging.handlers.QueueHandler(log_queue)]
+    root.setLevel(level)
+    # O httpx loga cada requisição da Bot API em INFO
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+setup_logging()
+logger = logging.getLogger("qbt_bot")
+
+# Métricas dos caminhos quentes: ciclo do monitor, chamadas ao qBit, Telegram e envios
+MONITOR_TICK_SECONDS = Histogram(
+    "qbt_bot_monitor_tick_seconds", "Duração de um ciclo do monitor", ["instance"],
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+MONITOR_TORRENTS = Gauge("qbt_bot_monitor_torrents", "Torrents conhecidos por instância", ["instance"])
+MONITOR_INTERVAL_SECONDS = Gauge("qbt_bot_monitor_interval_seconds", "Intervalo até o próximo ciclo", ["instance"])
+QBT_REQUEST_SECONDS = Histogram(
+    "qbt_bot_qbittorrent_request_seconds", "Latência das chamadas ao qBittorrent", ["instance", "method"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+QBT_REQUEST_ERRORS = Counter("qbt_bot_qbittorrent_errors_total", "Chamadas ao qBittorrent com erro", ["instance", "method"])
+TELEGRAM_REQUESTS = Counter(
+    "qbt_bot_telegram_requests_total", "Chamadas ao Telegram por operação e resultado", ["operation", "outcome"]
+)
+TELEGRAM_PENDING = Gauge("qbt_bot_telegram_pending", "Operações aguardando na fila do Telegram")
+ARCHIVE_BYTES = Counter("qbt_bot_archive_bytes_total", "Bytes compactados em partes")
+UPLOAD_BYTES = Counter("qbt_bot_upload_bytes_total", "Bytes enviados ao Telegram")
+ARCHIVE_BYTES_PER_SECOND = Gauge("qbt_bot_archive_bytes_per_second", "Vazão da compactação no último envio, incluindo a espera por envios")
+UPLOAD_BYTES_PER_SECOND = Gauge("qbt_bot_upload_bytes_per_second", "Vazão de ponta a ponta no último envio")
+STAGING_RESERVED = Gauge("qbt_bot_staging_reserved_bytes", "Espaço em disco reservado pelos envios em andamento")
+INGEST_EVENTS = Counter("qbt_bot_ingest_events_total", "Avisos de torrent concluído recebidos por resultado", ["result"])
+UPLOADS = Counter("qbt_bot_uploads_total", "Envios de torrents concluídos por resultado", ["status"])
+DEDUPE_BYTES_SAVED = Counter("qbt_bot_dedupe_bytes_saved_total", "Bytes reenviados pelo file_id em vez de subir de novo")
+
+# Estado persistente em SQLite (modo WAL), indexado pelo infohash: IDs das mensagens de status,
+# envios de torrents concluídos e as partes já enviadas de cada um, além do índice de conteúdo
+# da deduplicação (digest do arquivo -> file_id no Telegram)
+class StateStore:
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS messages (
+        hash TEXT PRIMARY KEY,
+        chat_id TEXT NOT NULL,
+        message_id INTEGER NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS uploads (
+        hash TEXT PRIMARY KEY,
+        name TEXT NOT NULL,
+        status TEXT NOT NULL,
+        compression TEXT NOT NULL,
+        part_size INTEGER NOT NULL,
+        total_parts INTEGER,
+        updated_at REAL NOT NULL,
+        size INTEGER NOT NULL DEFAULT 0,
+        tags TEXT NOT NULL DEFAULT ''
+    );
+    CREATE TABLE IF NOT EXISTS upload_parts (
+        hash TEXT NOT NULL,
+        part_num INTEGER NOT NULL,
+        digest TEXT NOT NULL,
+        message_id INTEGER NOT NULL,
+        link TEXT,
+        PRIMARY KEY (hash, part_num)
+    );
+    CREATE TABLE IF NOT EXISTS upload_files (
+        hash TEXT NOT NULL,
+        path TEXT NOT NULL,
+        digest TEXT NOT NULL,
+        message_id INTEGER NOT NULL,
+        link TEXT,
+        PRIMARY KEY (hash, path)
+    );
+    CREATE TABLE IF NOT EXISTS file_hashes (
+        path TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        mtime_ns INTEGER NOT NULL,
+        digest TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS content_index (
+        digest TEXT PRIMARY KEY,
+        file_id TEXT NOT NULL,
+        size INTEGER NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS settings (
+        name TEXT PRIMARY KEY,
+        value TEXT NOT NULL
+    );
+    """
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.db = sqlite3.connect(path, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(self.SCHEMA)
+        self._add_missing_columns("uploads", {"size": "INTEGER NOT NULL DEFAULT 0", "tags": "TEXT NOT NULL DEFAULT ''"})
+        # Torrents que já têm envio registrado, carregados na primeira consulta. O monitor vê os
+        # concluídos a cada ciclo, e assim só a primeira vez de cada um chega ao SQLite.
+        self._claimed = None
+
+    def _add_missing_columns(self, table, columns):
+        # Bancos criados por versões anteriores não têm as colunas novas
+        existing = {row[1] for row in self.db.execute(f"PRAGMA table_info({table})")}
+        for name, definition in columns.items():
+            if name not in existing:
+                self.db.execute(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
+
+    def namespace_legacy_keys(self, instance):
+        # Bancos de antes da frota guardavam só o infohash; passam a pertencer à primeira instância
+        for table in ("messages", "uploads", "upload_parts"):
+            self.db.execute(
+                f"UPDATE OR IGNORE {table} SET hash = ? || ':' || hash WHERE instr(hash, ':') = 0", (instance,)
+            )
+
+    def load_messages(self, chat_id):
+        rows = self.db.execute("SELECT hash, message_id FROM messages WHERE chat_id = ?", (str(chat_id),))
+        return dict(rows)
+
+    def set_message(self, torrent_hash, chat_id, message_id):
+        self.db.execute("INSERT OR REPLACE INTO messages VALUES (?, ?, ?)", (torrent_hash, str(chat_id), message_id))
+
+    def delete_message(self, torrent_hash):
+        self.db.execute("DELETE FROM messages WHERE hash = ?", (torrent_hash,))
+
+    def tracking_since(self, instance):
+        # Quando o bot passou a acompanhar a instância; gravado só na primeira vez
+        name = f"tracking_since:{instance}"
+        self.db.execute("INSERT OR IGNORE INTO settings VALUES (?, ?)", (name, str(int(time.time()))))
+        return int(self.db.execute("SELECT value FROM settings WHERE name = ?", (name,)).fetchone()[0])
+
+    def claim_upload(self, torrent_hash, name, compression, part_size, size=0, tags=""):
+        # Só o primeiro pedido de envio de um torrent é aceito; os seguintes são ignorados
+        if self._claimed is None:
+            self._claimed = {row[0] for row in self.db.execute("SELECT hash FROM uploads")}
+        if torrent_hash in self._claimed:
+            return False
+        cursor = self.db.execute(
+            "INSERT OR IGNORE INTO uploads VALUES (?, ?, 'pending', ?, ?, NULL, ?, ?, ?)",
+            (torrent_hash, name, compression, part_size, time.time(), size, tags),
+        )
+        self._claimed.add(torrent_hash)
+        return cursor.rowcount == 1
+
+    def get_upload(self, torrent_hash):
+        cursor = self.db.execute(
+            "SELECT hash, name, status, compression, part_size, total_parts, size, tags FROM uploads WHERE hash = ?",
+            (torrent_hash,),
+        )
+        row = cursor.fetchone()
+        return UploadRecord(*row) if row else None
+
+    def unfinished_uploads(self):
+        cursor = self.db.execute(
+            "SELECT hash, name, status, compression, part_size, total_parts, size, tags FROM uploads "
+            "WHERE status != 'done' ORDER BY updated_at"
+        )
+        return [UploadRecord(*row) for row in cursor]
+
+    def set_upload_status(self, torrent_hash, status, total_parts=None):
+        self.db.execute(
+            "UPDATE uploads SET status = ?, total_parts = COALESCE(?, total_parts), updated_at = ? WHERE hash = ?",
+            (status, total_parts, time.time(), torrent_hash),
+        )
+
+    def set_compression(self, torrent_hash, compression):
+        self.db.execute("UPDATE uploads SET compression = ? WHERE hash = ?", (compression, torrent_hash))
+
+    def set_part_size(self, torrent_hash, part_size):
+        self.db.execute("UPDATE uploads SET part_size = ? WHERE hash = ?", (part_size, torrent_hash))
+
+    def uploaded_parts(self, torrent_hash):
+        cursor = self.db.execute(
+            "SELECT part_num, digest, message_id, link FROM upload_parts WHERE hash = ? ORDER BY part_num",
+            (torrent_hash,),
+        )
+        return {row[0]: UploadedPart(*row[1:]) for row in cursor}
+
+    def record_part(self, torrent_hash, part_num, digest, message_id, link):
+        self.db.execute(
+            "INSERT OR REPLACE INTO upload_parts VALUES (?, ?, ?, ?, ?)",
+            (torrent_hash, part_num, digest, message_id, link),
+        )
+
+    def uploaded_files(self, torrent_hash):
+        cursor = self.db.execute(
+            "SELECT path, digest, message_id, link FROM upload_files WHERE hash = ?", (torrent_hash,)
+        )
+        return {row[0]: UploadedPart(*row[1:]) for row in cursor}
+
+    def record_file(self, torrent_hash, path, digest, message_id, link):
+        self.db.execute(
+            "INSERT OR REPLACE INTO upload_files VALUES (?, ?, ?, ?, ?)",
+            (torrent_hash, path, digest, message_id, link),
+        )
+
+    def cached_file_digest(self, path, size, mtime_ns):
+        # O digest guardado só vale se o arquivo não mudou desde que foi lido
+        row = self.db.execute(
+            "SELECT digest FROM file_hashes WHERE path = ? AND size = ? AND mtime_ns = ?", (path, size, mtime_ns)
+        ).fetchone()
+        return row[0] if row else None
+
+    def store_file_digest(self, path, size, mtime_ns, digest):
+        self.db.execute("INSERT OR REPLACE INTO file_hashes VALUES (?, ?, ?, ?)", (path, size, mtime_ns, digest))
+
+    def content_file_id(self, digest):
+        row = self.db.execute("SELECT file_id FROM content_index WHERE digest = ?", (digest,)).fetchone()
+        return row[0] if row else None
+
+    def index_content(self, digest, file_id, size):
+        if file_id:
+            self.db.execute("INSERT OR REPLACE INTO content_index VALUES (?, ?, ?)", (digest, file_id, size))
+
+    def discard_parts_from(self, torrent_hash, part_num):
+        self.db.execute("DELETE FROM upload_parts WHERE hash = ? AND part_num >= ?", (torrent_hash, part_num))
+
+UploadRecord = namedtuple(
+    "UploadRecord", ["hash", "name", "status", "compression", "part_size", "total_parts", "size", "tags"]
+)
+UploadedPart = namedtuple("UploadedPart", ["digest", "message_id", "link"])
+
+state_store = StateStore(STATE_DB_PATH)
+state_store.namespace_legacy_keys(QB_INSTANCES[0].name)
+
+# Digest do último texto enviado para um torrent e os valores que o geraram
+RenderEntry = namedtuple("RenderEntry", ["digest", "state", "progress", "dlspeed", "upspeed", "sent_at"])
+
+
+# Estado de cada torrent acompanhado pelo bot: ID da mensagem de status, último momento com
+# upload ativo, a última renderização enviada e quando o torrent foi processado pela última vez.
+# __slots__ mantém cada registro pequeno.
+class TorrentRecord:
+    __slots__ = ("message_id", "last_uploaded", "render", "checked_at", "checked_state")
+
+    def __init__(self, message_id=None, last_uploaded=0.0, render=None):
+        self.message_id = message_id
+        self.last_uploaded = last_uploaded
+        self.render = render
+        self.checked_at = 0.0
+        self.checked_state = None
+
+
+# Tabela única de estado, indexada por "instância:hash" e reconciliada a cada ciclo com os
+# torrents que ainda existem em cada qBit, para não acumular registros de torrents removidos
+class TorrentStateTable:
+    def __init__(self, message_ids=None):
+        self.records = {
+            torrent_hash: TorrentRecord(message_id) for torrent_hash, message_id in (message_ids or {}).items()
+        }
+
+    def __len__(self):
+        return len(self.records)
+
+    def get(self, torrent_hash):
+        return self.records.get(torrent_hash)
+
+    def ensure(self, torrent_hash):
+        record = self.records.get(torrent_hash)
+        if record is None:
+            record = self.records[torrent_hash] = TorrentRecord()
+        return record
+
+    def message_id(self, torrent_hash):
+        record = self.records.get(torrent_hash)
+        return record.message_id if record is not None else None
+
+    def reconcile(self, live_keys, instance):
+        # Remove e devolve os registros da instância cujos torrents não existem mais
+        prefix = f"{instance}:"
+        removed = [key for key in self.records if key.startswith(prefix) and key not in live_keys]
+        return [(key, self.records.pop(key)) for key in removed]
+
+# Carregada do banco, para as mensagens continuarem sendo editadas depois de um reinício
+torrent_states = TorrentStateTable({
+    key: message_id for key, message_id in state_store.load_messages(CHAT_ID).items()
+    if not key.startswith(DASHBOARD_KEY_PREFIX)
+})
+
+# Torrents com envio em andamento neste processo
+active_uploads = set()
+
+# Estados exibidos com o modelo de download
+DOWNLOAD_STATES = ["downloading", "stoppedDL", "queuedDL"]
+
+# Estados de um torrent com o download concluído; "moving" e "checkingUP" ficam de fora porque
+# os arquivos ainda podem mudar de lugar ou ser regravados
+COMPLETED_STATES = {"uploading", "stalledUP", "forcedUP", "queuedUP", "stoppedUP", "pausedUP"}
+
+# Valores usados quando um torrent chega sem algum campo lido pelo monitor
+TORRENT_DEFAULTS = {
+    "name": "", "state": "unknown", "progress": 0.0, "downloaded": 0, "total_size": 0,
+    "dlspeed": 0, "upspeed": 0, "eta": 0, "time_active": 0, "tags": "", "ratio": 0.0,
+    "uploaded": 0, "category": "", "completion_on": 0,
+}
 
 # Mensagens globais
 DOWNLOAD_MESSAGE_TEMPLATE = """\
@@ -57,230 +555,2345 @@ UPLOADED: {uploaded:.2f}GB
 """
 
 # Verifica se todas as variáveis de ambiente estão presentes
-if not QB_HOST:
-    print("Erro: QB_HOST não está definido.")
-if not QB_USERNAME:
-    print("Erro: QB_USERNAME não está definido.")
-if not QB_PASSWORD:
-    print("Erro: QB_PASSWORD não está definido.")
-
-# Checa a conexão com o qBit
-def connect_to_qbittorrent():
-    try:
-        print(f"Tentando conectar ao qBittorrent em {QB_HOST}...")
-        qbt = Client(host=QB_HOST, username=QB_USERNAME, password=QB_PASSWORD)
-        qbt.auth_log_in()
-        print("Conexão estabelecida com sucesso!")
-        return qbt
-    except Exception as e:
-        print(f"Erro ao conectar ao qBittorrent: {str(e)}")
-        return None
+for config in QB_INSTANCES:
+    label = "QB" if config.name == "default" else f"QB_{config.name.upper()}"
+    if not config.host:
+        logger.error("%s_HOST não está definido.", label)
+    if not config.username:
+        logger.error("%s_USERNAME não está definido.", label)
+    if not config.password:
+        logger.error("%s_PASSWORD não está definido.", label)
 
-# Função para obter espaço livre do HD onde o qBit está configurado
-def get_free_space_from_qbittorrent(qbt):
+# O modo fica gravado em cada envio registrado; um modo inválido travaria esses envios
+if ARCHIVE_COMPRESSION not in ARCHIVE_MODES:
+    logger.error("ARCHIVE_COMPRESSION=%s inválido; use %s.", ARCHIVE_COMPRESSION, " | ".join(ARCHIVE_MODES))
+    raise SystemExit(1)
+
+# Acesso assíncrono ao qBit: o Client é síncrono, então as chamadas rodam em um executor
+# dedicado, com sessão HTTP keep-alive compartilhada e timeout por chamada
+class AsyncQBittorrent:
+    def __init__(self, host, username, password, timeout=QB_TIMEOUT, pool_size=QB_POOL_SIZE, name="default"):
+        self.name = name
+        self.timeout = timeout
+        self.client = Client(
+            host=host,
+            username=username,
+            password=password,
+            REQUESTS_ARGS={"timeout": timeout},
+            HTTPADAPTER_ARGS={"pool_connections": pool_size, "pool_maxsize": pool_size, "pool_block": True},
+        )
+        self._executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="qbt")
+
+    async def call(self, method, *args, timeout=None, **kwargs):
+        func = partial(getattr(self.client, method), *args, **kwargs)
+        started = time.perf_counter()
+        try:
+            future = asyncio.get_running_loop().run_in_executor(self._executor, func)
+            return await asyncio.wait_for(future, timeout or self.timeout)
+        except Exception:
+            QBT_REQUEST_ERRORS.labels(self.name, method).inc()
+            raise
+        finally:
+            QBT_REQUEST_SECONDS.labels(self.name, method).observe(time.perf_counter() - started)
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+# Checa a conexão com uma instância do qBit. O cliente é devolvido mesmo se o login falhar,
+# para o monitor continuar tentando com backoff sem atrasar as outras instâncias.
+async def connect_to_qbittorrent(config):
+    qbt = AsyncQBittorrent(config.host, config.username, config.password, timeout=config.timeout, name=config.name)
     try:
-        main_data = qbt.sync.maindata()
-        free_space_bytes = main_data.get('server_state', {}).get('free_space_on_disk', None)
-        if free_space_bytes is not None:
-            return free_space_bytes / (1024 ** 3)
-        return "Indisponível"
+        logger.info("Tentando conectar ao qBittorrent '%s' em %s...", config.name, config.host)
+        await qbt.call("auth_log_in")
+        logger.info("Conexão com '%s' estabelecida com sucesso!", config.name)
+        return qbt, True
     except Exception as e:
-        print(f"Erro ao obter espaço livre do qBittorrent: {e}")
-        return "Erro ao acessar API"
+        logger.error("Erro ao conectar ao qBittorrent '%s': %s", config.name, str(e) or type(e).__name__)
+        return qbt, False
+
+# Índices de nome e tag do snapshot, atualizados só para os torrents que mudaram no delta.
+# Para a busca por substring, os nomes normalizados são juntados num único texto, refeito só
+# quando algum nome muda; cada busca é um str.find em C sobre esse texto, sem varrer objetos.
+class TorrentIndex:
+    def __init__(self):
+        self.names = {}
+        self.torrent_tags = {}
+        self.tags = defaultdict(set)
+        self._haystack = None
+        self._offsets = []
+        self._keys = []
+
+    def update(self, key, torrent):
+        name = torrent.name.casefold()
+        if self.names.get(key) != name:
+            self.names[key] = name
+            self._haystack = None
+        tags = parse_tags(torrent.tags)
+        if self.torrent_tags.get(key) != tags:
+            self._drop_tags(key)
+            self.torrent_tags[key] = tags
+            for tag in tags:
+                self.tags[tag].add(key)
+
+    def discard(self, key):
+        if self.names.pop(key, None) is not None:
+            self._haystack = None
+        self._drop_tags(key)
+
+    def clear(self):
+        self.names.clear()
+        self.torrent_tags.clear()
+        self.tags.clear()
+        self._haystack = None
+
+    def _drop_tags(self, key):
+        for tag in self.torrent_tags.pop(key, ()):
+            keys = self.tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.tags[tag]
+
+    def _build(self):
+        # Nomes separados por "\n", que não aparece no texto procurado
+        self._keys = list(self.names)
+        self._offsets, position = [], 0
+        for key in self._keys:
+            self._offsets.append(position)
+            position += len(self.names[key]) + 1
+        self._haystack = "\n".join(self.names[key] for key in self._keys)
+
+    def find(self, text):
+        needle = text.casefold().replace("\n", " ")
+        if self._haystack is None:
+            self._build()
+        found, position = [], self._haystack.find(needle)
+        while position != -1:
+            index = bisect.bisect_right(self._offsets, position) - 1
+            found.append(self._keys[index])
+            # Continua a partir do próximo nome, para cada torrent aparecer uma vez só
+            next_start = self._offsets[index + 1] if index + 1 < len(self._offsets) else len(self._haystack)
+            position = self._haystack.find(needle, next_start)
+        return found
+
+    def tagged(self, tag):
+        return self.tags.get(tag.casefold(), set())
+
+def parse_tags(tags):
+    return frozenset(tag.strip().casefold() for tag in tags.split(",") if tag.strip())
+
+# Tabela local de torrents mantida a partir dos deltas do sync/maindata. As chaves são
+# "instância:hash", para torrents de instâncias diferentes nunca colidirem.
+class TorrentSync:
+    def __init__(self, instance="default"):
+        self.instance = instance
+        self.rid = 0
+        self.torrents = {}
+        self.server_state = {}
+        self.index = TorrentIndex()
+        self.synced_at = None
+
+    def key(self, torrent_hash):
+        return f"{self.instance}:{torrent_hash}"
+
+    def reset(self):
+        # Força uma ressincronização completa na próxima consulta
+        self.rid = 0
+        self.torrents.clear()
+        self.server_state = {}
+        self.index.clear()
+        self.synced_at = None
+
+    def apply(self, data):
+        # Com full_update o qBit manda a tabela inteira, então descartamos a local
+        if data.get("full_update"):
+            self.torrents.clear()
+            self.server_state = {}
+            self.index.clear()
+
+        for torrent_hash, fields in (data.get("torrents") or {}).items():
+            key = self.key(torrent_hash)
+            torrent = self.torrents.get(key)
+            created = torrent is None
+            if created:
+                torrent = SimpleNamespace(hash=torrent_hash, key=key, instance=self.instance, **TORRENT_DEFAULTS)
+                self.torrents[key] = torrent
+            vars(torrent).update(fields)
+            # A maioria dos deltas traz só velocidades e progresso; o índice só muda com nome ou tags
+            if created or "name" in fields or "tags" in fields:
+                self.index.update(key, torrent)
+
+        for torrent_hash in data.get("torrents_removed") or ():
+            key = self.key(torrent_hash)
+            self.torrents.pop(key, None)
+            self.index.discard(key)
+
+        self.server_state.update(data.get("server_state") or {})
+        self.rid = data.get("rid", 0)
+        self.synced_at = time.time()
+
+    async def poll(self, qbt):
+        # Uma única chamada por ciclo serve a lista de torrents e o server_state
+        try:
+            self.apply(await qbt.call("sync_maindata", rid=self.rid))
+        except Exception:
+            self.reset()
+            raise
+        return list(self.torrents.values())
+
+# Calcula o intervalo até o próximo ciclo do monitor
+class AdaptiveInterval:
+    def __init__(self, minimum=MONITOR_MIN_INTERVAL, base=MONITOR_INTERVAL, maximum=MONITOR_MAX_INTERVAL):
+        self.minimum = minimum
+        self.base = max(minimum, min(base, maximum))
+        self.maximum = maximum
+        self.current = self.base
+        # Progresso dos downloads no ciclo anterior, para notar quem andou entre um ciclo e outro
+        self.progress = {}
+
+    def next(self, torrents):
+        previous = self.progress
+        self.progress = {torrent.key: torrent.progress for torrent in torrents if torrent.progress < 1.0}
+        if any(is_hot(torrent, previous.get(torrent.key)) for torrent in torrents):
+            self.current = self.minimum
+        elif any(is_busy(torrent) for torrent in torrents):
+            self.current = self.base
+        else:
+            self.backoff()
+        return self.current
+
+    def backoff(self):
+        # Nada acontecendo (ou qBit fora do ar): espera cada vez mais, até o máximo
+        self.current = min(self.maximum, max(self.current, self.base) * 2)
+        return self.current
+
+# Uma instância monitorada: cliente próprio, tabela de sincronização própria e intervalo
+# adaptativo próprio, para uma instância lenta ou fora do ar não atrasar as outras
+class QBInstance:
+    def __init__(self, config):
+        self.config = config
+        self.name = config.name
+        self.qbt = None
+        self.sync = TorrentSync(config.name)
+        self.interval = AdaptiveInterval()
+        self.tracking_since = state_store.tracking_since(config.name)
+
+    @property
+    def downloads_path(self):
+        return self.config.downloads_path
+
+qb_instances = {config.name: QBInstance(config) for config in QB_INSTANCES}
+
+# Instância dona de uma chave "instância:hash"
+def instance_for_key(key):
+    return qb_instances.get(key.partition(":")[0])
+
+# Visão unificada de todas as instâncias
+def fleet_torrents():
+    return [torrent for instance in qb_instances.values() for torrent in instance.sync.torrents.values()]
+
+def fleet_free_space():
+    free = [get_free_space_from_qbittorrent(instance.sync.server_state) for instance in qb_instances.values()]
+    free = [value for value in free if isinstance(value, float)]
+    return sum(free) if free else "Indisponível"
+
+# Função para obter espaço livre do HD a partir do server_state do qBit
+def get_free_space_from_qbittorrent(server_state):
+    free_space_bytes = server_state.get('free_space_on_disk', None)
+    if free_space_bytes is not None:
+        return free_space_bytes / (1024 ** 3)
+    return "Indisponível"
+
+# Fila de saída para o Telegram, com token bucket global e por chat. Operações pendentes
+# com a mesma chave são substituídas pela mais recente, e RetryAfter é tratado aqui.
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def delay(self):
+        # Segundos até haver uma ficha disponível
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def block(self, seconds):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class TelegramScheduler:
+    def __init__(self, global_rate=TG_GLOBAL_RATE, chat_rate=TG_CHAT_RATE, chat_burst=TG_CHAT_BURST,
+                 max_inflight=TG_MAX_INFLIGHT):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.chat_buckets = {}
+        self.max_inflight = max_inflight
+        self.pending = {}
+        self.inflight = set()
+        # Envios de partes duram minutos: pegam fichas dos buckets, mas não ocupam as vagas de
+        # max_inflight, senão as edições de status ficariam presas atrás deles. A concorrência
+        # deles já é limitada por UPLOAD_WORKERS e UPLOAD_CONCURRENCY.
+        self.uploads = set()
+        self.inflight_uploads = set()
+        # Chaves pendentes por (chat, é envio de parte), na ordem de chegada. O despacho para de
+        # olhar uma fila assim que o bucket do chat manda esperar, em vez de testar cada chave.
+        self.lanes = {}
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._tasks = set()
+
+    def submit(self, chat_id, key, operation, attempts=TG_MAX_ATTEMPTS, upload=False):
+        # Agenda a operação e retorna um future com o resultado. Com key=None a operação
+        # nunca é agrupada; caso contrário, a mais recente substitui a pendente.
+        if key is None:
+            key = object()
+        if upload:
+            self.uploads.add(key)
+        future = asyncio.get_running_loop().create_future()
+        waiters = [future]
+        if key in self.pending:
+            waiters = self.pending[key][2] + waiters
+            if self.pending[key][0] != chat_id:
+                self._lane(self.pending[key][0], key).pop(key, None)
+        self.pending[key] = (chat_id, operation, waiters, attempts)
+        self._lane(chat_id, key)[key] = None
+        TELEGRAM_PENDING.set(len(self.pending))
+        self._wakeup.set()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        return future
+
+    def _lane(self, chat_id, key):
+        return self.lanes.setdefault((chat_id, key in self.uploads), {})
+
+    def _bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def _run(self):
+        while self.pending or self.inflight or self.inflight_uploads:
+            self._wakeup.clear()
+            wait = self._dispatch()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+    def _dispatch(self):
+        # Dispara o que já pode sair e retorna quanto esperar pelo próximo (None = até ser acordado)
+        wait = None
+        for lane in list(self.lanes):
+            chat_id, upload = lane
+            keys = self.lanes[lane]
+            bucket = self._bucket(chat_id)
+            started = []
+            for key in keys:
+                if not upload and len(self.inflight) >= self.max_inflight:
+                    break
+                if key in self.inflight:
+                    # A versão anterior desta chave ainda está em voo; esta espera a vez
+                    continue
+                delay = max(self.global_bucket.delay(), bucket.delay())
+                if delay > 0:
+                    # Sem ficha agora: nada mais deste chat sai neste despacho
+                    wait = delay if wait is None else min(wait, delay)
+                    break
+                self.global_bucket.take()
+                bucket.take()
+                (self.inflight_uploads if upload else self.inflight).add(key)
+                task = asyncio.create_task(self._execute(key, *self.pending.pop(key)))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+                started.append(key)
+            for key in started:
+                del keys[key]
+            if not keys:
+                del self.lanes[lane]
+        TELEGRAM_PENDING.set(len(self.pending))
+        return wait
+
+    async def _execute(self, key, chat_id, operation, waiters, attempts):
+        outcome = "ok"
+        try:
+            result = await operation()
+        except RetryAfter as e:
+            outcome = "retry_after"
+            retry_after = e.retry_after
+            retry_after = retry_after.total_seconds() if hasattr(retry_after, "total_seconds") else retry_after
+            logger.warning("Telegram pediu para aguardar %ss no chat %s.", retry_after, chat_id)
+            self._bucket(chat_id).block(retry_after)
+            self._requeue(key, chat_id, operation, waiters, attempts)
+        except BadRequest as e:
+            # No python-telegram-bot o BadRequest herda de NetworkError, mas o Telegram recusou o
+            # pedido: repetir só gastaria fichas (ou reenviaria uma parte inteira) para ouvir o mesmo
+            outcome = "bad_request"
+            self._resolve(waiters, exception=e)
+        except (TimedOut, NetworkError) as e:
+            outcome = "timeout" if isinstance(e, TimedOut) else "network_error"
+            if attempts > 1:
+                self._requeue(key, chat_id, operation, waiters, attempts - 1)
+            else:
+                self._resolve(waiters, exception=e)
+        except Exception as e:
+            outcome = "error"
+            self._resolve(waiters, exception=e)
+        else:
+            self._resolve(waiters, result=result)
+        finally:
+            method, handled = telegram_call.get() or (operation_name(operation), None)
+            TELEGRAM_REQUESTS.labels(method, handled or outcome).inc()
+            self.inflight.discard(key)
+            self.inflight_uploads.discard(key)
+            if key not in self.pending:
+                self.uploads.discard(key)
+            self._wakeup.set()
+
+    def _requeue(self, key, chat_id, operation, waiters, attempts):
+        # Se uma versão mais nova já foi agendada, ela vence e herda quem estava esperando
+        if key in self.pending:
+            newer = self.pending[key]
+            self.pending[key] = (newer[0], newer[1], waiters + newer[2], newer[3])
+        else:
+            self.pending[key] = (chat_id, operation, waiters, attempts)
+            self._lane(chat_id, key)[key] = None
+
+    @staticmethod
+    def _resolve(waiters, result=None, exception=None):
+        for future in waiters:
+            if future.done():
+                continue
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
+
+telegram_scheduler = TelegramScheduler()
+
+# Método do Bot API de fato chamado (e o resultado, se a operação tratou o erro) por operações
+# que só decidem na hora entre editar e enviar. Cada operação roda na sua própria task, então o
+# valor não vaza para as outras.
+telegram_call = contextvars.ContextVar("telegram_call", default=None)
+
+# Nome da operação para as métricas: o da função por trás dos partial
+def operation_name(operation):
+    while isinstance(operation, partial):
+        operation = operation.func
+    return getattr(operation, "__name__", "operation")
 
 # Enviar ou editar mensagem no Telegram
-async def send_or_edit_message(bot, message, torrent_name):
-    if torrent_name in torrent_message_ids:
+async def send_or_edit_message(bot, message, torrent_hash):
+    message_id = torrent_states.message_id(torrent_hash)
+    if message_id is not None:
         # Edita a mensagem se ela já existe
-        message_id = torrent_message_ids[torrent_name]
-        await bot.edit_message_text(chat_id=CHAT_ID, message_id=message_id, text=message)
-    else:
-        # Envia uma nova mensagem e armazena o ID
-        sent_message = await bot.send_message(chat_id=CHAT_ID, text=message)
-        torrent_message_ids[torrent_name] = sent_message.message_id
+        telegram_call.set(("edit_message_text", None))
+        try:
+            await bot.edit_message_text(chat_id=CHAT_ID, message_id=message_id, text=message)
+            return
+        except BadRequest as e:
+            # O Telegram recusa edições com o mesmo texto; não há nada a fazer nesse caso
+            if "not modified" in str(e).lower():
+                telegram_call.set(("edit_message_text", "not_modified"))
+                return
+            # A mensagem pode ter sido apagada no chat; nesse caso enviamos uma nova
+            if "not found" not in str(e).lower():
+                raise
+            TELEGRAM_REQUESTS.labels("edit_message_text", "bad_request").inc()
+
+    # Envia uma nova mensagem e armazena o ID
+    telegram_call.set(("send_message", None))
+    sent_message = await bot.send_message(chat_id=CHAT_ID, text=message)
+    torrent_states.ensure(torrent_hash).message_id = sent_message.message_id
+    state_store.set_message(torrent_hash, CHAT_ID, sent_message.message_id)
+
+# Apaga a mensagem de status do torrent e esquece o ID dela
+def delete_status_message(bot, torrent_hash, message_id):
+    state_store.delete_message(torrent_hash)
+    if message_id:
+        future = telegram_scheduler.submit(
+            CHAT_ID, ("status", torrent_hash), partial(bot.delete_message, chat_id=CHAT_ID, message_id=message_id)
+        )
+        future.add_done_callback(partial(on_status_update_done, torrent_hash))
+
+# Decide se o texto renderizado mudou o suficiente para justificar uma edição
+def should_render(torrent, message):
+    record = torrent_states.get(torrent.key)
+    if record is None or record.message_id is None or record.render is None:
+        return True
+    cached = record.render
+    if cached.digest == render_digest(message):
+        return False
+    return (
+        torrent.state != cached.state
+        or abs(torrent.progress - cached.progress) * 100 >= RENDER_PROGRESS_DELTA
+        or abs(torrent.dlspeed - cached.dlspeed) / (1024 ** 2) >= RENDER_SPEED_DELTA
+        or abs(torrent.upspeed - cached.upspeed) / (1024 ** 2) >= RENDER_SPEED_DELTA
+        or time.time() - cached.sent_at >= RENDER_MAX_AGE
+    )
+
+# Registra o que foi efetivamente enviado para o torrent
+def remember_render(torrent, message):
+    torrent_states.ensure(torrent.key).render = RenderEntry(
+        digest=render_digest(message),
+        state=torrent.state,
+        progress=torrent.progress,
+        dlspeed=torrent.dlspeed,
+        upspeed=torrent.upspeed,
+        sent_at=time.time(),
+    )
+
+def render_digest(message):
+    return hashlib.blake2b(message.encode(), digest_size=16).digest()
+
+# Agenda a atualização de status do torrent; só o texto mais recente de cada torrent é enviado
+def schedule_status_update(bot, message, torrent):
+    remember_render(torrent, message)
+    future = telegram_scheduler.submit(
+        CHAT_ID, ("status", torrent.key), partial(send_or_edit_message, bot, message, torrent.key)
+    )
+    future.add_done_callback(partial(on_status_update_done, torrent.key))
+
+def on_status_update_done(torrent_hash, future):
+    if not future.cancelled() and future.exception() is not None:
+        # Sem o envio confirmado, o próximo ciclo precisa renderizar de novo
+        record = torrent_states.get(torrent_hash)
+        if record is not None:
+            record.render = None
+        logger.warning("Erro ao atualizar a mensagem do torrent: %s", future.exception())
 
 # Função para converter os segundos
 def format_time(seconds):
     return time.strftime("%H:%M:%S", time.gmtime(seconds))
 
+# Métricas do host, amostradas uma vez por ciclo e compartilhadas por todas as mensagens
+HostMetrics = namedtuple("HostMetrics", ["cpu_percent", "ram_percent", "uptime"])
+
+# O boot_time não muda enquanto o processo estiver vivo
+BOOT_TIME = psutil.boot_time()
+
+# A primeira leitura do cpu_percent sempre retorna 0.0, então já deixamos a base pronta
+psutil.cpu_percent()
+
+def sample_host_metrics():
+    return HostMetrics(
+        cpu_percent=psutil.cpu_percent(),
+        ram_percent=psutil.virtual_memory().percent,
+        uptime=format_time(time.time() - BOOT_TIME),
+    )
+
 ssl._create_default_https_context = ssl._create_unverified_context
 
 # Função que trata o comando /start
 async def start_download(update: Update, context: CallbackContext):
-    print("Comando /start recebido")
+    logger.info("Comando /start recebido")
     await update.message.reply_text("Bot iniciado com sucesso!")
 
-    # Tenta conectar ao qBit
-    qbt = connect_to_qbittorrent()
-    if qbt is None:
-        await send_or_edit_message(update.message.bot, "Erro ao conectar ao qBittorrent.", "")
+    # Tenta conectar a todas as instâncias ao mesmo tempo
+    instances = list(qb_instances.values())
+    results = await asyncio.gather(*(connect_to_qbittorrent(instance.config) for instance in instances))
+    failed = [instance.name for instance, (_, connected) in zip(instances, results) if not connected]
+    if len(failed) == len(instances):
+        for qbt, _ in results:
+            qbt.close()
+        await update.message.reply_text("Erro ao conectar ao qBittorrent.")
         return
+    if failed:
+        await update.message.reply_text(f"Sem conexão com: {', '.join(failed)}. Tentando de novo em segundo plano.")
 
-    # Inicia o monitoramento dos torrents
-    print("Iniciando monitoramento dos torrents")
-    job = context.job_queue.run_repeating(monitor_torrents, interval=7, first=0, data=qbt)
+    # Retoma envios que ficaram pela metade antes do último reinício
+    resume_unfinished_uploads(context.bot)
 
-# Função para monitorar o status dos torrents
-async def monitor_torrents(context: CallbackContext):
-    print("Executando monitoramento dos torrents...")
-    qbt = context.job.data
+    # Inicia o monitoramento de cada instância a partir de uma sincronização completa. Um /start
+    # repetido substitui o monitoramento anterior em vez de criar um segundo.
+    logger.info("Iniciando monitoramento dos torrents")
+    for instance, (qbt, _) in zip(instances, results):
+        if instance.qbt is not None:
+            instance.qbt.close()
+        instance.qbt = qbt
+        instance.sync.reset()
+        for job in context.job_queue.get_jobs_by_name(f"monitor:{instance.name}"):
+            job.schedule_removal()
+        context.job_queue.run_once(monitor_torrents, when=0, data=(instance, qbt), name=f"monitor:{instance.name}")
+
+
+# Torrents que pedem o intervalo mínimo: recebendo dados de fato, pela velocidade ou pelo
+# progresso desde o ciclo anterior. Parados, na fila ou travados não contam, nem perto do fim.
+def is_hot(torrent, previous_progress=None):
+    if torrent.progress >= 1.0:
+        return False
+    return torrent.dlspeed > 0 or (previous_progress is not None and torrent.progress > previous_progress)
+
+# Torrents que seguram o intervalo normal: enviando dados ou em verificação/movimentação, que
+# terminam sozinhas e mudam o estado do torrent
+def is_busy(torrent):
+    return torrent.upspeed > 0 or torrent.state in ("checkingDL", "checkingUP", "checkingResumeData", "moving")
+
+# Classe de atualização: downloads a cada ciclo, seeds de vez em quando e parados raramente
+def refresh_class(torrent):
+    if torrent.state in DOWNLOAD_STATES or (torrent.progress < 1.0 and torrent.dlspeed > 0):
+        return "active"
+    if torrent.upspeed > 0:
+        return "seeding"
+    return "idle"
 
-    if qbt is None:
-        print("qBittorrent não conectado!")
+def is_due(torrent, now):
+    record = torrent_states.get(torrent.key)
+    if record is None or record.checked_state != torrent.state:
+        return True
+    return now - record.checked_at >= REFRESH_INTERVALS[refresh_class(torrent)]
+
+def mark_checked(torrent, now):
+    record = torrent_states.ensure(torrent.key)
+    record.checked_at = now
+    record.checked_state = torrent.state
+
+# Função para monitorar o status dos torrents de uma instância. Cada instância tem sua própria
+# cadeia de ciclos, e cada ciclo agenda o próximo com um intervalo que se adapta à atividade.
+async def monitor_torrents(context: CallbackContext):
+    instance, qbt = context.job.data
+    if qbt is not instance.qbt:
+        # Ciclo de um cliente já substituído; não mexe no sync nem no intervalo do novo
         return
+    interval = instance.interval.current
+    started = time.perf_counter()
+    try:
+        interval = await run_monitor_tick(context, instance, qbt)
+    finally:
+        MONITOR_TICK_SECONDS.labels(instance.name).observe(time.perf_counter() - started)
+        MONITOR_TORRENTS.labels(instance.name).set(len(instance.sync.torrents))
+        MONITOR_INTERVAL_SECONDS.labels(instance.name).set(interval)
+        if qbt is instance.qbt:
+            context.job_queue.run_once(
+                monitor_torrents, when=interval, data=(instance, qbt), name=f"monitor:{instance.name}"
+            )
+
+async def run_monitor_tick(context, instance, qbt):
+    logger.debug("Executando monitoramento dos torrents de '%s'...", instance.name)
+
+    try:
+        torrents = await instance.sync.poll(qbt)
+    except Exception as e:
+        if qbt is not instance.qbt:
+            return instance.interval.current
+        logger.warning("Erro ao sincronizar com o qBittorrent '%s': %s", instance.name, str(e) or type(e).__name__)
+        return instance.interval.backoff()
+    if qbt is not instance.qbt:
+        # Um /start trocou o cliente durante a sincronização; o ciclo novo assume daqui
+        return instance.interval.current
+    free_space_gb = get_free_space_from_qbittorrent(instance.sync.server_state)
+    host = sample_host_metrics()
 
-    torrents = qbt.torrents_info()
-    free_space_gb = get_free_space_from_qbittorrent(qbt)
+    # Esquece torrents removidos do qBit e apaga as mensagens de status que ficaram para trás
+    for key, record in torrent_states.reconcile(instance.sync.torrents, instance.name):
+        delete_status_message(context.bot, key, record.message_id)
 
+    now = time.time()
     for torrent in torrents:
-        # Verifica se o torrent está sem atividade de upload há mais de 5s
-        if torrent.upspeed == 0 and torrent.state == 'stalledUP':
-            last_uploaded = torrent_last_uploaded.get(torrent.name, 0)
-            #print(f"Monitorando inatividade do torrent: {torrent.name}")
-            #print(f"Tempo atual: {time.time()}, Último upload: {last_uploaded}, Diferença: {time.time() - last_uploaded}")
-
-            if torrent.name in torrent_message_ids:
-                if time.time() - last_uploaded > 15:  # segundos
-                    message_id = torrent_message_ids[torrent.name]
-                    print(f"Excluindo mensagem para o torrent {torrent.name} devido à inatividade de upload.")
-                    if message_id:
-                        await context.bot.delete_message(chat_id=CHAT_ID, message_id=message_id)
-                    del torrent_message_ids[torrent.name]  # Remove a mensagem do dicionário
-                    del torrent_last_uploaded[torrent.name]  # Remove a entrada do dicionário
-                else:
-                    # Atualiza last_uploaded se o torrent voltou a ter atividade temporária
-                    torrent_last_uploaded[torrent.name] = time.time()
-            else:
-                # print(f"Registrando o tempo inicial de inatividade para '{torrent.name}'.")
-                torrent_last_uploaded[torrent.name] = time.time()
-
-        # Processa torrents que estão baixando ou pausados
-        if torrent.state in ["downloading", "stoppedDL", "queuedDL"]:
-            eta = format_time(torrent.eta) if torrent.eta > 0 else "N/A"
-            elapsed = format_time(torrent.time_active)
-
-            message = DOWNLOAD_MESSAGE_TEMPLATE.format(
-                torrent_name=torrent.name,
-                status=torrent.state,
-                progress_bar=f"{int(torrent.progress * 10) * '▰'}{(10 - int(torrent.progress * 10)) * '▱'}",
-                progress=torrent.progress * 100,
-                downloaded=torrent.downloaded / (1024 ** 3),
-                total_size=torrent.total_size / (1024 ** 3),
-                dlspeed=torrent.dlspeed / (1024 ** 2),
-                eta=eta,
-                time_elapsed=elapsed,
-                cpu_percent=psutil.cpu_percent(),
-                free_space_gb=free_space_gb,
-                ram_percent=psutil.virtual_memory().percent,
-                uptime=format_time(time.time() - psutil.boot_time()),
-                upspeed=torrent.upspeed / (1024 ** 2),
-                tag=torrent.tags,
-                ratio=torrent.ratio,
-                uploaded=torrent.uploaded / (1024 ** 3)
-            )
-            await send_or_edit_message(context.bot, message, torrent.name)
-
-        # Exibe status de seeding como uma atualização da mensagem de download
-        elif torrent.upspeed > 0:
-            elapsed = format_time(torrent.time_active)
-
-            message = SEEDING_MESSAGE_TEMPLATE.format(
-                torrent_name=torrent.name,
-                progress_bar=f"{int(torrent.progress * 10) * '▰'}{(10 - int(torrent.progress * 10)) * '▱'}",
-                progress=torrent.progress * 100,
-                downloaded=torrent.downloaded / (1024 ** 3),
-                total_size=torrent.total_size / (1024 ** 3),
-                cpu_percent=psutil.cpu_percent(),
-                free_space_gb=free_space_gb,
-                ram_percent=psutil.virtual_memory().percent,
-                uptime=format_time(time.time() - psutil.boot_time()),
-                dlspeed=torrent.dlspeed / (1024 ** 2),
-                upspeed=torrent.upspeed / (1024 ** 2),
-                tag=torrent.tags,
-                ratio=torrent.ratio,
-                uploaded=torrent.uploaded / (1024 ** 3)
-            )
-            await send_or_edit_message(context.bot, message, torrent.name)
-        # Verificação de finalização de download
-        if torrent.state == "stalledUP" and torrent.progress == 1.0:
-            print(f"Download concluído para '{torrent.name}'. Iniciando compactação e envio.")
-            await send_completed_torrent_parts(context, torrent.name, os.path.join(DOWNLOADS_PATH, torrent.name))
+        if DISPLAY_MODE == "torrent" and is_due(torrent, now):
+            update_torrent_message(context.bot, torrent, free_space_gb, host)
+            mark_checked(torrent, now)
+
+        # Verificação de finalização de download. Normalmente o aviso do qBit pelo endpoint de
+        # ingestão chega antes; aqui fica a reconciliação para avisos perdidos.
+        enqueue_if_completed(context.bot, torrent.key, torrent, instance.tracking_since)
 
 
         # Armazena o tempo do último upload se há atividade de upload
         if torrent.upspeed > 0:
-            print(f"Atualizando o tempo de upload ativo para '{torrent.name}'.")
-            torrent_last_uploaded[torrent.name] = time.time()
+            logger.debug("Atualizando o tempo de upload ativo para '%s'.", torrent.name)
+            torrent_states.ensure(torrent.key).last_uploaded = time.time()
+    if DISPLAY_MODE == "dashboard":
+        dashboard.update(context.bot, fleet_torrents(), fleet_free_space(), host)
 
-# Função para dividir e enviar arquivos compactados
-async def send_completed_torrent_parts(context, torrent_name, files_path):
-    part_pattern = None #Para função inteira ter acesso a variavel.
-    try:
-        # Cria uma pasta temporária para o torrent
-        temp_folder = os.path.join("/tmp", torrent_name.replace(" ", "_"))
-        os.makedirs(temp_folder, exist_ok=True)
-
-        # Verifica se 'files_path' é um diretório ou arquivo
-        if os.path.isdir(files_path):
-            # Copia todos os arquivos de um diretório para a pasta temporária
-            for file in os.listdir(files_path):
-                original_path = os.path.join(files_path, file)
-                if os.path.isfile(original_path):
-                    shutil.copy2(original_path, temp_folder)
-        elif os.path.isfile(files_path):
-            # Se for um arquivo único, copia diretamente
-            shutil.copy2(files_path, temp_folder)
+    return instance.interval.next(torrents)
+
+# Coloca o torrent na fila de envio se o download terminou; o banco garante um único envio.
+# Na reconciliação do monitor, since deixa de fora o que já estava concluído antes de o bot
+# passar a acompanhar a instância, para a biblioteca existente não ser enviada inteira.
+def enqueue_if_completed(bot, key, torrent, since=None):
+    if torrent.progress < 1.0 or torrent.state not in COMPLETED_STATES:
+        return False
+    if since is not None and torrent.completion_on < since:
+        return False
+    if state_store.claim_upload(key, torrent.name, ARCHIVE_COMPRESSION, ARCHIVE_PART_SIZE, torrent.total_size, torrent.tags):
+        logger.info("Download concluído para '%s'. Colocando na fila de envio.", torrent.name)
+        upload_queue.enqueue(bot, state_store.get_upload(key))
+    return True
+
+# Atualiza a mensagem individual do torrent (modo "torrent")
+def update_torrent_message(bot, torrent, free_space_gb, host):
+    # Verifica se o torrent está sem atividade de upload há mais de 5s
+    if torrent.upspeed == 0 and torrent.state == 'stalledUP':
+        record = torrent_states.ensure(torrent.key)
+        last_uploaded = record.last_uploaded
+        #print(f"Monitorando inatividade do torrent: {torrent.name}")
+        #print(f"Tempo atual: {time.time()}, Último upload: {last_uploaded}, Diferença: {time.time() - last_uploaded}")
+
+        if record.message_id is not None:
+            if time.time() - last_uploaded > 15:  # segundos
+                logger.info("Excluindo mensagem para o torrent %s devido à inatividade de upload.", torrent.name)
+                delete_status_message(bot, torrent.key, record.message_id)
+                record.message_id = None
+                record.last_uploaded = 0.0
+                record.render = None
+            else:
+                # Atualiza last_uploaded se o torrent voltou a ter atividade temporária
+                record.last_uploaded = time.time()
         else:
-            print(f"Erro: {files_path} não é um arquivo nem um diretório válido.")
+            # print(f"Registrando o tempo inicial de inatividade para '{torrent.name}'.")
+            record.last_uploaded = time.time()
+
+    # Numa frota, o nome leva a instância na frente, como nas consultas
+    torrent_name = f"[{torrent.instance}] {torrent.name}" if len(qb_instances) > 1 else torrent.name
+
+    # Processa torrents que estão baixando ou pausados
+    if torrent.state in DOWNLOAD_STATES:
+        eta = format_time(torrent.eta) if torrent.eta > 0 else "N/A"
+        elapsed = format_time(torrent.time_active)
+
+        message = DOWNLOAD_MESSAGE_TEMPLATE.format(
+            torrent_name=torrent_name,
+            status=torrent.state,
+            progress_bar=f"{int(torrent.progress * 10) * '▰'}{(10 - int(torrent.progress * 10)) * '▱'}",
+            progress=torrent.progress * 100,
+            downloaded=torrent.downloaded / (1024 ** 3),
+            total_size=torrent.total_size / (1024 ** 3),
+            dlspeed=torrent.dlspeed / (1024 ** 2),
+            eta=eta,
+            time_elapsed=elapsed,
+            cpu_percent=host.cpu_percent,
+            free_space_gb=free_space_gb,
+            ram_percent=host.ram_percent,
+            uptime=host.uptime,
+            upspeed=torrent.upspeed / (1024 ** 2),
+            tag=torrent.tags,
+            ratio=torrent.ratio,
+            uploaded=torrent.uploaded / (1024 ** 3)
+        )
+        if should_render(torrent, message):
+            schedule_status_update(bot, message, torrent)
+
+    # Exibe status de seeding como uma atualização da mensagem de download
+    elif torrent.upspeed > 0:
+        elapsed = format_time(torrent.time_active)
+
+        message = SEEDING_MESSAGE_TEMPLATE.format(
+            torrent_name=torrent_name,
+            progress_bar=f"{int(torrent.progress * 10) * '▰'}{(10 - int(torrent.progress * 10)) * '▱'}",
+            progress=torrent.progress * 100,
+            downloaded=torrent.downloaded / (1024 ** 3),
+            total_size=torrent.total_size / (1024 ** 3),
+            cpu_percent=host.cpu_percent,
+            free_space_gb=free_space_gb,
+            ram_percent=host.ram_percent,
+            uptime=host.uptime,
+            dlspeed=torrent.dlspeed / (1024 ** 2),
+            upspeed=torrent.upspeed / (1024 ** 2),
+            tag=torrent.tags,
+            ratio=torrent.ratio,
+            uploaded=torrent.uploaded / (1024 ** 3)
+        )
+        if should_render(torrent, message):
+            schedule_status_update(bot, message, torrent)
+
+# Painel agregado (modo "dashboard"): um número fixo de mensagens, cada uma mostrando uma página
+# dos torrents ativos, ordenada e agrupada, com botões para trocar de página e de ordenação.
+# As edições por ciclo ficam constantes, não importa quantos torrents existam.
+DASHBOARD_SORTS = {
+    "speed": ("Velocidade", lambda torrent: -(torrent.dlspeed + torrent.upspeed)),
+    "eta": ("ETA", lambda torrent: torrent.eta if 0 < torrent.eta < 8640000 else float("inf")),
+    "progress": ("Progresso", lambda torrent: -torrent.progress),
+}
+DASHBOARD_GROUPS = {
+    "state": lambda torrent: torrent.state,
+    "instance": lambda torrent: torrent.instance,
+    "tag": lambda torrent: torrent.tags.split(",")[0].strip() or "sem tag",
+    "none": lambda torrent: "",
+}
+
+
+class DashboardSlot:
+    __slots__ = ("message_id", "page", "sort", "digest")
+
+    def __init__(self, message_id=None, page=0, sort=DASHBOARD_SORT):
+        self.message_id = message_id
+        self.page = page
+        self.sort = sort
+        self.digest = None
+
+
+class Dashboard:
+    def __init__(self, slots=DASHBOARD_MESSAGES, page_size=DASHBOARD_PAGE_SIZE, group=DASHBOARD_GROUP):
+        saved = state_store.load_messages(CHAT_ID)
+        # Cada mensagem começa mostrando uma página diferente
+        self.slots = [
+            DashboardSlot(saved.get(f"{DASHBOARD_KEY_PREFIX}{index}"), page=index) for index in range(slots)
+        ]
+        self.page_size = page_size
+        self.group = group
+        self.view = ([], "Indisponível", None)
+
+    def update(self, bot, torrents, free_space_gb, host):
+        # Guarda a última visão para os botões responderem sem esperar o próximo ciclo
+        self.view = ([torrent for torrent in torrents if is_active(torrent)], free_space_gb, host)
+        for index in range(len(self.slots)):
+            self.refresh(bot, index)
+
+    def refresh(self, bot, index):
+        slot = self.slots[index]
+        text, markup = self.render(index)
+        digest = render_digest(text)
+        if digest == slot.digest:
             return
+        slot.digest = digest
+        future = telegram_scheduler.submit(
+            CHAT_ID, ("dashboard", index), partial(self.send_or_edit, bot, index, text, markup)
+        )
+        future.add_done_callback(partial(self.on_done, index))
+
+    def pages(self, count):
+        return max(1, -(-count // self.page_size))
+
+    def render(self, index):
+        slot = self.slots[index]
+        active, free_space_gb, host = self.view
+        label, sort_key = DASHBOARD_SORTS[slot.sort]
+        group_key = DASHBOARD_GROUPS[self.group]
+        ordered = sorted(active, key=lambda torrent: (group_key(torrent), sort_key(torrent)))
+        pages = self.pages(len(ordered))
+        slot.page = min(slot.page, pages - 1)
+
+        free = f"{free_space_gb:.2f}GB" if isinstance(free_space_gb, float) else free_space_gb
+        lines = [
+            f"Painel {index + 1}/{len(self.slots)} | Página {slot.page + 1}/{pages} | Ordem: {label}",
+            f"Ativos: {len(active)} | DL: {sum(t.dlspeed for t in active) / (1024 ** 2):.2f} MB/s"
+            f" | UL: {sum(t.upspeed for t in active) / (1024 ** 2):.2f} MB/s",
+        ]
+        if host is not None:
+            lines.append(f"CPU: {host.cpu_percent}% | RAM: {host.ram_percent}% | FREE: {free} | UPTIME: {host.uptime}")
+
+        current_group = None
+        for torrent in ordered[slot.page * self.page_size:(slot.page + 1) * self.page_size]:
+            group = group_key(torrent)
+            if group != current_group and self.group != "none":
+                lines.append(f"\n[{group}]")
+                current_group = group
+            lines.append(format_torrent_line(torrent))
+        if not ordered:
+            lines.append("\nNenhum torrent ativo.")
+
+        buttons = [
+            [
+                InlineKeyboardButton("◀", callback_data=f"dash:{index}:prev"),
+                InlineKeyboardButton(f"{slot.page + 1}/{pages}", callback_data=f"dash:{index}:noop"),
+                InlineKeyboardButton("▶", callback_data=f"dash:{index}:next"),
+            ],
+            [
+                InlineKeyboardButton(("✓ " if key == slot.sort else "") + name, callback_data=f"dash:{index}:sort:{key}")
+                for key, (name, _) in DASHBOARD_SORTS.items()
+            ],
+        ]
+        return "\n".join(lines)[:4096], InlineKeyboardMarkup(buttons)
+
+    async def send_or_edit(self, bot, index, text, markup):
+        slot = self.slots[index]
+        if slot.message_id is not None:
+            try:
+                await bot.edit_message_text(chat_id=CHAT_ID, message_id=slot.message_id, text=text, reply_markup=markup)
+                return
+            except BadRequest as e:
+                if "not modified" in str(e).lower():
+                    return
+                if "not found" not in str(e).lower():
+                    raise
+        sent_message = await bot.send_message(chat_id=CHAT_ID, text=text, reply_markup=markup)
+        slot.message_id = sent_message.message_id
+        state_store.set_message(f"{DASHBOARD_KEY_PREFIX}{index}", CHAT_ID, sent_message.message_id)
+
+    def on_done(self, index, future):
+        if not future.cancelled() and future.exception() is not None:
+            self.slots[index].digest = None
+            logger.warning("Erro ao atualizar o painel: %s", future.exception())
+
+    def handle(self, bot, index, action):
+        slot = self.slots[index]
+        pages = self.pages(len(self.view[0]))
+        if action == "prev":
+            slot.page = (slot.page - 1) % pages
+        elif action == "next":
+            slot.page = (slot.page + 1) % pages
+        elif action.startswith("sort:") and action[5:] in DASHBOARD_SORTS:
+            slot.sort = action[5:]
+            slot.page = 0
+        self.refresh(bot, index)
+
+dashboard = Dashboard()
+
+# Uma linha compacta por torrent, usada no painel e nas respostas das consultas
+def format_torrent_line(torrent, extra=""):
+    filled = int(torrent.progress * 10)
+    eta = format_time(torrent.eta) if 0 < torrent.eta < 8640000 else "N/A"
+    return (
+        f"{filled * '▰'}{(10 - filled) * '▱'} {torrent.progress * 100:.1f}% "
+        f"↓{torrent.dlspeed / (1024 ** 2):.2f} ↑{torrent.upspeed / (1024 ** 2):.2f} MB/s "
+        f"ETA {eta}{extra} | {torrent.name[:DASHBOARD_NAME_WIDTH]}"
+    )
+
+# Torrents que aparecem nas mensagens de status: baixando, pausados/na fila ou enviando dados
+def is_active(torrent):
+    return torrent.state in DOWNLOAD_STATES or torrent.upspeed > 0
+
+# Função que trata os botões do painel
+async def dashboard_callback(update: Update, context: CallbackContext):
+    query = update.callback_query
+    _, index, action = query.data.split(":", 2)
+    index = int(index)
+    if 0 <= index < len(dashboard.slots) and action != "noop":
+        dashboard.handle(context.bot, index, action)
+    await query.answer()
+
+# Acumula o arquivo compactado em partes de tamanho fixo e entrega cada parte assim que fica pronta.
+# Partes pequenas ficam em memória; acima de ARCHIVE_MEMORY_LIMIT elas passam para um arquivo
+# temporário anônimo, que é apagado assim que a parte é fechada.
+ArchivePart = namedtuple("ArchivePart", ["num", "file", "size", "digest"])
+
+
+class PartSplitter(io.RawIOBase):
+    def __init__(self, part_size, on_part, memory_limit=ARCHIVE_MEMORY_LIMIT):
+        self.part_size = part_size
+        self.on_part = on_part
+        self.memory_limit = memory_limit
+        self.count = 0
+        self._new_part()
+
+    def writable(self):
+        return True
+
+    def _new_part(self):
+        self.current = io.BytesIO()
+        self.size = 0
+        self.hasher = hashlib.blake2b(digest_size=16)
+
+    def write(self, data):
+        view = memoryview(data).cast("B")
+        while view:
+            chunk = view[:self.part_size - self.size]
+            view = view[len(chunk):]
+            if isinstance(self.current, io.BytesIO) and self.size + len(chunk) > self.memory_limit:
+                spilled = tempfile.TemporaryFile(dir=STAGING_PATH)
+                spilled.write(self.current.getbuffer())
+                self.current = spilled
+            self.current.write(chunk)
+            self.hasher.update(chunk)
+            self.size += len(chunk)
+            if self.size >= self.part_size:
+                self._emit()
+        return len(data)
+
+    def finish(self):
+        # Entrega a última parte, que normalmente é menor que as outras
+        if self.size:
+            self._emit()
 
-        # Compacta a pasta em partes de 2GB
-        archive_name = os.path.join("/tmp", f"{torrent_name.replace(' ', '_')}")
-        print("Iniciando compactação em partes")
+    def _emit(self):
+        self.count += 1
+        self.current.seek(0)
+        part = ArchivePart(self.count, self.current, self.size, self.hasher.hexdigest())
+        self._new_part()
+        self.on_part(part)
 
-        # Substituir o comando de split e tar por algo mais seguro
-        split_command = f"tar -czf - -C /tmp {torrent_name.replace(' ', '_')} | split -b 50MB - {archive_name}.part"
 
-        # Executar o comando com subprocess
-        process = subprocess.Popen(split_command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        stdout, stderr = process.communicate()
+class ArchiveCancelled(Exception):
+    pass
 
-        # Verifique se houve erros durante a execução do comando
-        if process.returncode != 0:
-            print(f"Erro ao executar o comando de compactação/divisão: {stderr.decode()}")
+
+# gzip em blocos independentes, comprimidos em paralelo. Cada bloco vira um membro gzip, e
+# membros concatenados continuam sendo um .gz válido para o gzip e o tar. No modo adaptativo,
+# blocos que não comprimem (vídeo, rar, zip...) são gravados sem compressão.
+class ParallelGzipWriter(io.RawIOBase):
+    def __init__(self, fileobj, level, threads, adaptive=False, block_size=ARCHIVE_BLOCK_SIZE):
+        self.fileobj = fileobj
+        self.level = level
+        self.threads = threads
+        self.adaptive = adaptive
+        self.block_size = block_size
+        self.buffer = bytearray()
+        self.pending = deque()
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="gzip")
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            self._submit(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+        return len(data)
+
+    def _submit(self, block):
+        self.pending.append(self.executor.submit(compress_gzip_block, block, self.level, self.adaptive))
+        # Mantém só alguns blocos em voo para a memória não crescer
+        while len(self.pending) > self.threads * 2:
+            self.fileobj.write(self.pending.popleft().result())
+
+    def close(self):
+        if not self.closed:
+            try:
+                if self.buffer:
+                    self._submit(bytes(self.buffer))
+                    self.buffer = bytearray()
+                while self.pending:
+                    self.fileobj.write(self.pending.popleft().result())
+            finally:
+                self.executor.shutdown(cancel_futures=True)
+        super().close()
+
+
+def compress_gzip_block(block, level, adaptive):
+    if not adaptive:
+        return gzip.compress(block, compresslevel=level, mtime=0)
+    # Decide trecho a trecho, para um arquivo pequeno de texto não herdar a decisão de um vídeo vizinho
+    step = ARCHIVE_ADAPTIVE_CHUNK
+    return b"".join(
+        gzip.compress(chunk, compresslevel=0 if is_incompressible(chunk) else level, mtime=0)
+        for chunk in (block[i:i + step] for i in range(0, len(block), step))
+    )
+
+
+# Amostra o início do bloco com a compressão mais rápida para ver se vale a pena comprimir
+def is_incompressible(block):
+    sample = block[:ARCHIVE_SAMPLE_SIZE]
+    return len(zlib.compress(sample, 1)) > len(sample) * ARCHIVE_INCOMPRESSIBLE_RATIO
+
+
+# Extensão do arquivo gerado para cada modo de compressão
+ARCHIVE_EXTENSIONS = {"store": ".tar", "gzip": ".tar.gz", "auto": ".tar.gz", "zstd": ".tar.zst"}
+
+
+def open_compressor(fileobj, compression=ARCHIVE_COMPRESSION, level=ARCHIVE_COMPRESSION_LEVEL):
+    if compression == "store":
+        return nullcontext(fileobj)
+    if compression in ("gzip", "auto"):
+        return ParallelGzipWriter(fileobj, level if level is not None else 6, ARCHIVE_THREADS,
+                                  adaptive=compression == "auto")
+    if compression == "zstd":
+        compressor = zstandard.ZstdCompressor(level=level if level is not None else 3, threads=ARCHIVE_THREADS)
+        return compressor.stream_writer(fileobj, closefd=False)
+    raise ValueError(f"Modo de compressão desconhecido: {compression}")
+
+
+# Monta o arquivo direto a partir do DOWNLOADS_PATH, sem cópia intermediária
+def write_archive(files_path, arcname, fileobj, compression=ARCHIVE_COMPRESSION, exclude=frozenset()):
+    with open_compressor(fileobj, compression) as compressed:
+        with tarfile.open(fileobj=compressed, mode="w|") as tar:
+            # Membros em exclude (enviados avulsos pela deduplicação) ficam fora do tar
+            tar.add(files_path, arcname=arcname, filter=lambda info: None if info.name in exclude else info)
+
+
+# Gera as partes do arquivo compactado em uma thread, com no máximo ARCHIVE_QUEUE_DEPTH partes
+# prontas esperando upload, para a memória e o disco não crescerem com o tamanho do torrent.
+# Cada parte vem com um digest, usado para conferir se uma retomada está gerando os mesmos bytes.
+# Threads próprias do envio. Cada worker tem um produtor de partes, que passa a maior parte do
+# tempo bloqueado esperando vaga na fila; as leituras que esvaziam essa fila ficam em outro pool,
+# então produtores parados nunca tomam as threads de que os envios precisam para andar.
+archive_executor = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS, thread_name_prefix="archive")
+upload_read_executor = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS * UPLOAD_CONCURRENCY, thread_name_prefix="upload-read")
+
+async def stream_archive_parts(files_path, arcname, part_size=ARCHIVE_PART_SIZE, compression=ARCHIVE_COMPRESSION,
+                               exclude=frozenset(), queue_depth=ARCHIVE_QUEUE_DEPTH):
+    loop = asyncio.get_running_loop()
+    parts = asyncio.Queue(maxsize=queue_depth)
+    cancelled = threading.Event()
+
+    def put(item):
+        if cancelled.is_set():
+            raise ArchiveCancelled()
+        asyncio.run_coroutine_threadsafe(parts.put(item), loop).result()
+
+    def on_part(part):
+        try:
+            put(part)
+        except ArchiveCancelled:
+            part.file.close()
+            raise
+
+    def produce():
+        # Com todas as threads ocupadas a tarefa pode começar depois de o envio já ter desistido
+        if cancelled.is_set():
             return
+        try:
+            splitter = PartSplitter(part_size, on_part)
+            write_archive(files_path, arcname, splitter, compression, exclude)
+            splitter.finish()
+            put(None)
+        except ArchiveCancelled:
+            pass
+        except Exception as e:
+            try:
+                put(e)
+            except ArchiveCancelled:
+                pass
+
+    producer = loop.run_in_executor(archive_executor, produce)
+    try:
+        while True:
+            item = await parts.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        # Libera a thread caso ela esteja bloqueada esperando espaço na fila
+        cancelled.set()
+        while not producer.done() or not parts.empty():
+            while not parts.empty():
+                item = parts.get_nowait()
+                if isinstance(item, ArchivePart):
+                    item.file.close()
+            await asyncio.wait({producer}, timeout=0.1)
+
+# Backends de upload. Os dois passam pelo agendador, que cuida do limite de envio, do
+# RetryAfter e de repetir só a parte que falhou, e devolvem o ID e o link da mensagem.
+SentDocument = namedtuple("SentDocument", ["message_id", "link", "file_id"])
+
+
+# O InputFile do python-telegram-bot lê o arquivo inteiro para a memória antes de enviar, então
+# a Bot API recebe o sendDocument montado aqui: um multipart com Content-Length exato, gerado
+# em blocos de UPLOAD_BUFFER_SIZE direto do arquivo, e a memória não cresce com o tamanho da parte
+upload_http_client = None
+
+def get_upload_http_client():
+    global upload_http_client
+    if upload_http_client is None:
+        connections = UPLOAD_WORKERS * UPLOAD_CONCURRENCY
+        upload_http_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(UPLOAD_TIMEOUT, connect=10.0),
+            limits=httpx.Limits(max_connections=connections, max_keepalive_connections=connections),
+        )
+    return upload_http_client
+
+
+class BotApiUploader:
+    max_part_size = BOT_API_MAX_PART_SIZE
+
+    def __init__(self, bot):
+        self.bot = bot
+
+    async def send_document(self, chat_id, fileobj, file_name, caption):
+        async def send_part():
+            payload = await self.stream_document(chat_id, fileobj, file_name, caption)
+            message = Message.de_json(payload, self.bot)
+            return SentDocument(message.message_id, message.link, message.document.file_id)
+
+        return await telegram_scheduler.submit(chat_id, None, send_part, attempts=UPLOAD_RETRIES, upload=True)
+
+    async def stream_document(self, chat_id, fileobj, file_name, caption):
+        boundary = uuid.uuid4().hex
+        file_name = file_name.replace('"', "'")
+        head = "".join(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'
+            for name, value in (("chat_id", chat_id), ("caption", caption))
+        ) + (
+            f'--{boundary}\r\nContent-Disposition: form-data; name="document"; filename="{file_name}"\r\n'
+            "Content-Type: application/octet-stream\r\n\r\n"
+        )
+        head, tail = head.encode(), f"\r\n--{boundary}--\r\n".encode()
+        size = fileobj.seek(0, os.SEEK_END)
+
+        async def body():
+            loop = asyncio.get_running_loop()
+            fileobj.seek(0)
+            yield head
+            while chunk := await loop.run_in_executor(upload_read_executor, fileobj.read, UPLOAD_BUFFER_SIZE):
+                yield chunk
+            yield tail
+
+        try:
+            response = await get_upload_http_client().post(
+                f"{self.bot.base_url}/sendDocument",
+                content=body(),
+                headers={
+                    "Content-Type": f"multipart/form-data; boundary={boundary}",
+                    "Content-Length": str(len(head) + size + len(tail)),
+                },
+            )
+        except httpx.TimeoutException as e:
+            raise TimedOut(str(e)) from e
+        except httpx.TransportError as e:
+            raise NetworkError(str(e) or type(e).__name__) from e
+        return parse_bot_api_response(response)
+
+# Converte a resposta da Bot API nas exceções do python-telegram-bot, que o agendador já trata
+def parse_bot_api_response(response):
+    try:
+        data = response.json()
+    except ValueError:
+        raise NetworkError(f"Resposta inválida da Bot API ({response.status_code})")
+    if data.get("ok"):
+        return data["result"]
+    description = data.get("description") or f"Erro {response.status_code}"
+    retry_after = (data.get("parameters") or {}).get("retry_after")
+    if retry_after is not None:
+        raise RetryAfter(int(retry_after))
+    if response.status_code == 400:
+        raise BadRequest(description)
+    if response.status_code in (401, 403):
+        raise Forbidden(description)
+    raise NetworkError(description)
+
+
+class MTProtoUploader:
+    max_part_size = MTPROTO_MAX_PART_SIZE
+
+    def __init__(self):
+        # O pyrogram usa o tgcrypto automaticamente quando ele está instalado
+        self.client = pyrogram.Client(
+            "qbt_uploader",
+            api_id=int(TELEGRAM_API_ID),
+            api_hash=TELEGRAM_API_HASH,
+            bot_token=BOT_TOKEN,
+            workdir=os.path.dirname(os.path.abspath(STATE_DB_PATH)),
+            no_updates=True,
+            max_concurrent_transmissions=UPLOAD_WORKERS * UPLOAD_CONCURRENCY,
+        )
+
+    async def send_document(self, chat_id, fileobj, file_name, caption):
+        async def send_part():
+            fileobj.seek(0)
+            try:
+                message = await self.client.send_document(
+                    int(chat_id), fileobj, file_name=file_name, caption=caption, force_document=True,
+                )
+            except FloodWait as e:
+                raise RetryAfter(int(e.value))
+            except (OSError, ConnectionError) as e:
+                raise NetworkError(str(e))
+            return SentDocument(message.id, message.link, message.document.file_id)
+
+        return await telegram_scheduler.submit(chat_id, None, send_part, attempts=UPLOAD_RETRIES, upload=True)
+
+
+mtproto_uploader = None
+mtproto_lock = asyncio.Lock()
+
+# Reenvia um documento já presente no Telegram pelo file_id, sem transferir os bytes de novo.
+# O file_id vale para o mesmo bot nos dois backends, então o reenvio sempre usa a Bot API.
+async def send_cached_document(bot, chat_id, file_id, caption):
+    async def send_cached():
+        message = await bot.send_document(chat_id=chat_id, document=file_id, caption=caption)
+        return SentDocument(message.message_id, message.link, file_id)
 
-        # Envia cada parte para o canal no Telegram
-        part_pattern = f"{archive_name}.part*"
-        part_num = 1
-        for part_file in sorted(glob.glob(part_pattern)):
-            with open(part_file, "rb") as file_part:
-                await context.bot.send_document(chat_id=FILE_CHAT_ID, document=InputFile(file_part),
-                                                caption=f"{torrent_name} - Parte {part_num}")
-            part_num += 1
-
-        # Envia uma mensagem final de confirmação
-       
-        await context.bot.send_message(chat_id=FILE_CHAT_ID,
-                                       text=f"O torrent '{torrent_name}' foi compactado e enviado com sucesso.")
-    except subprocess.CalledProcessError as e:
-        print(f"Erro ao executar o comando de compactação/divisão: {e}")
+    return await telegram_scheduler.submit(chat_id, None, send_cached, attempts=UPLOAD_RETRIES)
+
+# Digests de conteúdo para a deduplicação. O cache por (tamanho, mtime) evita reler arquivos
+# que não mudaram, e os arquivos novos são lidos em paralelo (o hashlib solta o GIL).
+hash_executor = ThreadPoolExecutor(max_workers=DEDUPE_HASH_WORKERS, thread_name_prefix="hash")
+
+def file_digest(path):
+    hasher = hashlib.blake2b(digest_size=32)
+    with open(path, "rb") as source:
+        while chunk := source.read(DEDUPE_READ_SIZE):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+async def hash_files(paths):
+    loop = asyncio.get_running_loop()
+    digests, pending = {}, []
+    for path in paths:
+        stat = os.stat(path)
+        cached = state_store.cached_file_digest(path, stat.st_size, stat.st_mtime_ns)
+        if cached is not None:
+            digests[path] = cached
+        else:
+            pending.append((path, stat))
+    results = await asyncio.gather(*(loop.run_in_executor(hash_executor, file_digest, path) for path, _ in pending))
+    for (path, stat), digest in zip(pending, results):
+        state_store.store_file_digest(path, stat.st_size, stat.st_mtime_ns, digest)
+        digests[path] = digest
+    return digests
+
+# Arquivos regulares do torrent com o nome que teriam dentro do tar
+def list_archive_members(files_path, arcname):
+    if os.path.isfile(files_path):
+        return [(files_path, arcname)]
+    members = []
+    for root, _, names in os.walk(files_path):
+        for name in sorted(names):
+            path = os.path.join(root, name)
+            if os.path.isfile(path) and not os.path.islink(path):
+                relative = os.path.relpath(path, files_path).replace(os.sep, "/")
+                members.append((path, f"{arcname}/{relative}"))
+    return members
+
+# Escolhe o backend do envio. Se o MTProto falhar ao conectar, a Bot API assume, desde que as
+# partes caibam no limite dela.
+async def get_uploader(bot, part_size):
+    global mtproto_uploader
+    if USE_MTPROTO:
+        try:
+            async with mtproto_lock:
+                if mtproto_uploader is None:
+                    uploader = MTProtoUploader()
+                    await uploader.client.start()
+                    mtproto_uploader = uploader
+            return mtproto_uploader
+        except Exception as e:
+            if part_size > BOT_API_MAX_PART_SIZE:
+                raise
+            logger.warning("MTProto indisponível (%s); usando a Bot API.", e)
+    return BotApiUploader(bot)
+
+# Legendas acima do limite do Telegram dão BadRequest, que não é repetido e derrubaria o envio
+# inteiro; o excesso sai do meio, preservando o começo e o fim. O Telegram conta o limite em
+# unidades UTF-16, em que caracteres fora do BMP valem dois.
+CAPTION_LIMIT = 1024
+
+def document_caption(text, limit=CAPTION_LIMIT):
+    size = len(text.encode("utf-16-le")) // 2
+    if size <= limit:
+        return text
+    keep = (limit - 1) // 2 if size == len(text) else (limit - 1) // 4
+    return f"{text[:keep]}…{text[-keep:]}"
+
+# Divide o texto em mensagens que respeitam o limite de tamanho do Telegram
+def split_message(lines, limit=4096):
+    chunks, current = [], ""
+    for line in lines:
+        if current and len(current) + len(line) + 1 > limit:
+            chunks.append(current)
+            current = ""
+        current = f"{current}\n{line}" if current else line
+    if current:
+        chunks.append(current)
+    return chunks
+
+# Erros em que o Telegram recusou o pedido: a mesma parte seria recusada de novo
+PERMANENT_UPLOAD_ERRORS = (BadRequest, Forbidden)
+
+def failure_status(errors):
+    return "abandoned" if any(isinstance(error, PERMANENT_UPLOAD_ERRORS) for error in errors) else "failed"
+
+# Função para compactar e enviar o torrent em partes à medida que são geradas. O progresso fica no
+# banco, então um envio interrompido é retomado sem reenviar as partes que já chegaram ao Telegram.
+async def send_completed_torrent_parts(bot, torrent_hash, job=None, grant=None):
+    upload = state_store.get_upload(torrent_hash)
+    if upload is None or upload.status == "done" or torrent_hash in active_uploads:
+        return
+
+    torrent_name = upload.name
+    # Cada instância da frota tem a sua pasta de downloads
+    instance = instance_for_key(torrent_hash)
+    files_path = os.path.join(instance.downloads_path if instance else DOWNLOADS_PATH, torrent_name)
+    if not os.path.exists(files_path):
+        # Arquivos apagados ou movidos não voltam sozinhos; repetir não adianta
+        logger.error("%s não é um arquivo nem um diretório válido.", files_path)
+        state_store.set_upload_status(torrent_hash, "abandoned")
+        UPLOADS.labels("abandoned").inc()
+        return
+
+    if upload.compression not in ARCHIVE_EXTENSIONS:
+        # Registrado com um modo inválido antes da validação na inicialização; nenhuma parte
+        # chegou a sair com ele, então o envio recomeça com o modo configurado agora
+        logger.warning("Envio de '%s' com compressão inválida '%s'; usando '%s'.",
+                       torrent_name, upload.compression, ARCHIVE_COMPRESSION)
+        state_store.set_compression(torrent_hash, ARCHIVE_COMPRESSION)
+        upload = state_store.get_upload(torrent_hash)
+
+    arcname = torrent_name.replace(" ", "_")
+    slots = asyncio.Semaphore(grant.concurrency if grant else UPLOAD_CONCURRENCY)
+    uploads = {}
+    file_uploads = {}
+    reused = set()
+
+    async def send_or_reuse(fileobj, file_name, caption, digest, size):
+        # Conteúdo já enviado antes vai pelo file_id; o resto sobe e entra no índice
+        file_id = state_store.content_file_id(digest) if UPLOAD_DEDUPE else None
+        if file_id is not None:
+            message = await send_cached_document(bot, FILE_CHAT_ID, file_id, caption)
+            DEDUPE_BYTES_SAVED.inc(size)
+            reused.add(digest)
+            return message
+        message = await uploader.send_document(FILE_CHAT_ID, fileobj, file_name, caption)
+        UPLOAD_BYTES.inc(size)
+        if UPLOAD_DEDUPE:
+            state_store.index_content(digest, message.file_id, size)
+        return message
+
+    async def upload_and_record(part):
+        try:
+            message = await send_or_reuse(
+                part.file, f"{archive_name}.part{part.num:03d}", document_caption(f"{torrent_name} - Parte {part.num}"),
+                part.digest, part.size,
+            )
+            state_store.record_part(torrent_hash, part.num, part.digest, message.message_id, message.link)
+            if job is not None:
+                job.bytes_sent += part.size
+                job.parts_sent += 1
+            return UploadedPart(part.digest, message.message_id, message.link)
+        finally:
+            part.file.close()
+            slots.release()
+
+    async def upload_file(path, member, digest, size):
+        try:
+            with open(path, "rb") as source:
+                # O caminho completo fica no manifesto; a legenda leva só o nome do arquivo
+                caption = document_caption(f"{torrent_name} - {os.path.basename(member)}")
+                message = await send_or_reuse(source, os.path.basename(path), caption, digest, size)
+            state_store.record_file(torrent_hash, member, digest, message.message_id, message.link)
+            if job is not None:
+                job.bytes_sent += size
+            return UploadedPart(digest, message.message_id, message.link)
+        finally:
+            slots.release()
+
+    try:
+        # Tudo a partir daqui fica dentro do try, para o finally sempre liberar o active_uploads
+        active_uploads.add(torrent_hash)
+        state_store.set_upload_status(torrent_hash, "uploading")
+        archive_name = arcname + ARCHIVE_EXTENSIONS[upload.compression]
+        sent_parts = state_store.uploaded_parts(torrent_hash)
+        sent_files = state_store.uploaded_files(torrent_hash)
+        uploader = await get_uploader(bot, upload.part_size)
+        started = time.perf_counter()
+        archived = 0
+
+        # Com a deduplicação, arquivos grandes saem do tar e vão avulsos (ou pelo file_id, se o
+        # conteúdo já foi enviado). A escolha só depende do tamanho, então é a mesma numa retomada.
+        members = list_archive_members(files_path, arcname)
+        exclude = set()
+        if UPLOAD_DEDUPE:
+            large = [(path, member) for path, member in members
+                     if DEDUPE_MIN_SIZE <= os.path.getsize(path) <= uploader.max_part_size]
+            digests = await hash_files([path for path, _ in large])
+            for path, member in large:
+                exclude.add(member)
+                sent = sent_files.get(member)
+                if sent is not None and sent.digest == digests[path]:
+                    continue
+                await slots.acquire()
+                file_uploads[member] = asyncio.create_task(
+                    upload_file(path, member, digests[path], os.path.getsize(path))
+                )
+
+        if len(exclude) < len(members) or not members:
+            logger.info("Iniciando compactação em partes")
+            # Até UPLOAD_CONCURRENCY partes sobem ao mesmo tempo; a compactação espera quando todas estão ocupadas
+            async for part in stream_archive_parts(files_path, arcname, upload.part_size, upload.compression, exclude,
+                                                   grant.queue_depth if grant else ARCHIVE_QUEUE_DEPTH):
+                ARCHIVE_BYTES.inc(part.size)
+                archived += part.size
+                sent = sent_parts.get(part.num)
+                if sent is not None and sent.digest == part.digest:
+                    part.file.close()
+                    continue
+                if sent is not None:
+                    # Os arquivos mudaram desde a última tentativa: as partes anteriores continuam
+                    # válidas, mas desta em diante tudo precisa ser reenviado
+                    logger.warning("Parte %s de '%s' mudou desde o último envio; reenviando o restante.", part.num, torrent_name)
+                    state_store.discard_parts_from(torrent_hash, part.num)
+                    sent_parts = {num: sent for num, sent in sent_parts.items() if num < part.num}
+                await slots.acquire()
+                uploads[part.num] = asyncio.create_task(upload_and_record(part))
+            ARCHIVE_BYTES_PER_SECOND.set(archived / max(time.perf_counter() - started, 1e-6))
+
+        results = await asyncio.gather(*uploads.values(), return_exceptions=True)
+        file_results = await asyncio.gather(*file_uploads.values(), return_exceptions=True)
+        failed = [(num, result) for num, result in zip(uploads, results) if isinstance(result, Exception)]
+        failed += [(member, result) for member, result in zip(file_uploads, file_results) if isinstance(result, Exception)]
+        if failed:
+            logger.error(
+                "Erro durante o envio das partes %s de '%s': %s", [num for num, _ in failed], torrent_name, failed[0][1]
+            )
+            status = failure_status(result for _, result in failed)
+            state_store.set_upload_status(torrent_hash, status)
+            UPLOADS.labels(status).inc()
+            return
+        sent_parts.update(zip(uploads, results))
+        sent_files.update(zip(file_uploads, file_results))
+
+        # Envia um manifesto com a ordem das partes e uma mensagem final de confirmação
+        total = len(sent_parts)
+        lines = [f"O torrent '{torrent_name}' foi compactado e enviado com sucesso em {total} parte(s):"]
+        for part_num in sorted(sent_parts):
+            part = sent_parts[part_num]
+            lines.append(f"Parte {part_num} de {total}: {part.link or part.message_id}")
+        if exclude:
+            lines.append(f"\nArquivos avulsos ({len(exclude)}):")
+            for member in sorted(exclude):
+                sent = sent_files[member]
+                note = " (reaproveitado)" if sent.digest in reused else ""
+                lines.append(f"{member}: {sent.link or sent.message_id}{note}")
+        for text in split_message(lines):
+            await telegram_scheduler.submit(FILE_CHAT_ID, None, partial(
+                bot.send_message, chat_id=FILE_CHAT_ID, text=text))
+        state_store.set_upload_status(torrent_hash, "done", total)
+        UPLOADS.labels("done").inc()
+        UPLOAD_BYTES_PER_SECOND.set(archived / max(time.perf_counter() - started, 1e-6))
     except Exception as ex:
-        print(f"Erro durante o envio das partes: {ex}")
+        logger.exception("Erro durante o envio das partes: %s", ex)
+        status = failure_status([ex])
+        state_store.set_upload_status(torrent_hash, status)
+        UPLOADS.labels(status).inc()
+    finally:
+        for task in [*uploads.values(), *file_uploads.values()]:
+            task.cancel()
+        active_uploads.discard(torrent_hash)
+
+# Retoma os envios que não terminaram, por exemplo depois de uma queda do bot
+def resume_unfinished_uploads(bot):
+    for upload in state_store.unfinished_uploads():
+        logger.info("Retomando o envio de '%s'.", upload.name)
+        upload_queue.enqueue(bot, upload)
+
+# Envio em andamento ou aguardando na fila, com os números exibidos pelo /queue
+class UploadJob:
+    def __init__(self, upload):
+        self.hash = upload.hash
+        self.name = upload.name
+        self.size = upload.size
+        self.tags = upload.tags
+        self.enqueued_at = time.time()
+        self.started_at = None
+        self.bytes_sent = 0
+        self.parts_sent = 0
+        self.waiting_for_space = False
+
+    def throughput(self):
+        # MB/s desde o início do envio
+        if self.started_at is None:
+            return 0.0
+        return self.bytes_sent / max(time.time() - self.started_at, 1e-6) / (1024 ** 2)
+
+
+# Controle de admissão do staging: antes de compactar, cada envio reserva o espaço em disco que
+# as partes vão ocupar no STAGING_PATH. Sem espaço para o plano completo, o envio encolhe
+# (menos partes em voo, depois partes que cabem só em memória); sem espaço nem assim, espera
+# até outro envio liberar a reserva ou o disco esvaziar.
+StagingGrant = namedtuple("StagingGrant", ["part_size", "queue_depth", "concurrency", "reserved"])
+
+
+class StagingScheduler:
+    def __init__(self, path=STAGING_PATH, reserve=STAGING_RESERVE):
+        self.path = path
+        self.reserve = reserve
+        self.reserved = 0
+        self._changed = asyncio.Condition()
+
+    @staticmethod
+    def estimate(size, part_size, queue_depth, concurrency):
+        # Partes até ARCHIVE_MEMORY_LIMIT nunca vão para o disco
+        if part_size <= ARCHIVE_MEMORY_LIMIT:
+            return 0
+        # Ficam no disco ao mesmo tempo as partes na fila, as que estão subindo e a que está sendo
+        # escrita. A compressão não entra como economia: vídeo e outros dados incompressíveis
+        # saem do mesmo tamanho em qualquer modo, então o pior caso é o tamanho do torrent
+        # mais os cabeçalhos do tar.
+        in_flight = (queue_depth + concurrency + 1) * part_size
+        return min(int(size * 1.01) + part_size, in_flight)
+
+    def available(self):
+        try:
+            free = shutil.disk_usage(self.path).free
+        except OSError:
+            return 0
+        return free - self.reserve - self.reserved
+
+    def plan(self, upload, can_resize):
+        options = [
+            (upload.part_size, ARCHIVE_QUEUE_DEPTH, UPLOAD_CONCURRENCY),
+            (upload.part_size, 1, 1),
+        ]
+        # O tamanho da parte só pode mudar antes da primeira parte enviada, senão a retomada quebra
+        if can_resize and upload.part_size > ARCHIVE_MEMORY_LIMIT:
+            options.append((ARCHIVE_MEMORY_LIMIT, 1, 1))
+        available = self.available()
+        for part_size, queue_depth, concurrency in options:
+            needed = self.estimate(upload.size, part_size, queue_depth, concurrency)
+            if needed <= available:
+                return StagingGrant(part_size, queue_depth, concurrency, needed)
+        return None
+
+    @asynccontextmanager
+    async def admit(self, upload, can_resize, job=None):
+        async with self._changed:
+            while (grant := self.plan(upload, can_resize)) is None:
+                if job is not None and not job.waiting_for_space:
+                    logger.warning("Sem espaço em %s para '%s'; aguardando.", self.path, upload.name)
+                    job.waiting_for_space = True
+                try:
+                    await asyncio.wait_for(self._changed.wait(), STAGING_RECHECK)
+                except asyncio.TimeoutError:
+                    pass
+            self.reserved += grant.reserved
+            STAGING_RESERVED.set(self.reserved)
+        if job is not None:
+            job.waiting_for_space = False
+        try:
+            yield grant
+        finally:
+            async with self._changed:
+                self.reserved -= grant.reserved
+                STAGING_RESERVED.set(self.reserved)
+                self._changed.notify_all()
+
+staging = StagingScheduler()
+
+# Fila de envios desacoplada do monitor: o monitor só enfileira e segue, e UPLOAD_WORKERS
+# tarefas processam os envios por prioridade (menores primeiro ou por tag)
+class UploadQueue:
+    def __init__(self, workers=UPLOAD_WORKERS):
+        self.workers = workers
+        self.queue = asyncio.PriorityQueue()
+        self.pending = {}
+        self.running = {}
+        self.bot = None
+        self._tasks = []
+        self._seq = 0
+        # Falhas seguidas por torrent e envios aguardando a próxima tentativa (hash -> (quando, nome, timer))
+        self.failures = {}
+        self.retrying = {}
+
+    def priority(self, job):
+        if UPLOAD_PRIORITY == "tag":
+            tags = {tag.strip() for tag in job.tags.split(",")}
+            rank = next((i for i, tag in enumerate(UPLOAD_PRIORITY_TAGS) if tag in tags), len(UPLOAD_PRIORITY_TAGS))
+            return rank, job.size
+        return (job.size,)
+
+    def enqueue(self, bot, upload):
+        if upload is None or upload.hash in self.pending or upload.hash in self.running:
+            return
+        # Um pedido explícito (como o /start) adianta a tentativa agendada e cancela o timer dela
+        retry = self.retrying.pop(upload.hash, None)
+        if retry is not None:
+            retry[2].cancel()
+        self.bot = bot
+        job = UploadJob(upload)
+        self.pending[job.hash] = job
+        self._seq += 1
+        self.queue.put_nowait((self.priority(job), self._seq, job.hash))
+        self._start_workers()
+
+    def _start_workers(self):
+        self._tasks = [task for task in self._tasks if not task.done()]
+        while len(self._tasks) < self.workers:
+            self._tasks.append(asyncio.create_task(self._worker()))
+
+    async def _worker(self):
+        while True:
+            _, _, torrent_hash = await self.queue.get()
+            job = self.pending.pop(torrent_hash, None)
+            if job is None:
+                continue
+            self.running[torrent_hash] = job
+            try:
+                upload = state_store.get_upload(torrent_hash)
+                if upload is None:
+                    continue
+                async with staging.admit(upload, not state_store.uploaded_parts(torrent_hash), job) as grant:
+                    if grant.part_size != upload.part_size:
+                        logger.info("Partes de '%s' reduzidas para %s bytes por falta de espaço.", job.name, grant.part_size)
+                        state_store.set_part_size(torrent_hash, grant.part_size)
+                    job.started_at = time.time()
+                    logger.info("Iniciando compactação e envio de '%s'.", job.name)
+                    await send_completed_torrent_parts(self.bot, torrent_hash, job, grant)
+            except Exception as e:
+                logger.exception("Erro no envio de '%s': %s", job.name, e)
+            finally:
+                del self.running[torrent_hash]
+            self._after_attempt(torrent_hash, job.name)
+
+    def _after_attempt(self, torrent_hash, name):
+        # Sem o envio concluído, agenda outra tentativa; as partes já enviadas não são repetidas
+        upload = state_store.get_upload(torrent_hash)
+        if upload is None or upload.status == "done":
+            self.failures.pop(torrent_hash, None)
+            return
+        attempts = self.failures[torrent_hash] = self.failures.get(torrent_hash, 0) + 1
+        if upload.status == "abandoned" or attempts >= UPLOAD_RETRY_LIMIT:
+            self.failures.pop(torrent_hash, None)
+            state_store.set_upload_status(torrent_hash, "abandoned")
+            logger.error("Envio de '%s' abandonado após %s tentativa(s); use /start para tentar de novo.", name, attempts)
+            return
+        delay = min(UPLOAD_RETRY_MAX_DELAY, UPLOAD_RETRY_DELAY * 2 ** (attempts - 1))
+        logger.warning("Envio de '%s' falhou (%s vez(es)); nova tentativa em %s.", name, attempts, format_time(delay))
+        timer = asyncio.get_running_loop().call_later(delay, self._retry, torrent_hash)
+        self.retrying[torrent_hash] = (time.time() + delay, name, timer)
+
+    def _retry(self, torrent_hash):
+        if self.retrying.pop(torrent_hash, None) is not None:
+            self.enqueue(self.bot, state_store.get_upload(torrent_hash))
+
+    def describe(self):
+        lines = [f"Fila de envio: {len(self.running)} em andamento, {len(self.pending)} aguardando"
+                 + (f", {len(self.retrying)} para tentar de novo" if self.retrying else "")]
+        for job in self.running.values():
+            if job.waiting_for_space:
+                lines.append(f"⏸ {job.name} — aguardando espaço em disco no staging")
+                continue
+            lines.append(
+                f"▶ {job.name} — {job.parts_sent} parte(s), {job.bytes_sent / (1024 ** 3):.2f}GB enviados "
+                f"de {job.size / (1024 ** 3):.2f}GB — {job.throughput():.2f} MB/s"
+            )
+        pending = sorted(self.pending.values(), key=lambda job: (self.priority(job), job.enqueued_at))
+        for position, job in enumerate(pending, start=1):
+            waiting = format_time(time.time() - job.enqueued_at)
+            lines.append(f"⏳ {position}. {job.name} — {job.size / (1024 ** 3):.2f}GB — aguardando há {waiting}")
+        for torrent_hash, (due, name, _) in sorted(self.retrying.items(), key=lambda item: item[1][0]):
+            attempts = self.failures.get(torrent_hash, 0)
+            lines.append(f"↻ {name} — {attempts} falha(s), nova tentativa em {format_time(max(0, due - time.time()))}")
+        return lines
+
+upload_queue = UploadQueue()
+
+# Função que trata o comando /queue
+async def show_queue(update: Update, context: CallbackContext):
+    for text in split_message(upload_queue.describe()):
+        await update.message.reply_text(text)
+
+# Consultas ao último snapshot do monitor. Nenhuma delas fala com o qBit: respondem a partir
+# das tabelas de sincronização e dos índices mantidos a cada ciclo, então custam milissegundos
+# mesmo com dezenas de milhares de torrents.
+TOP_ORDERS = {
+    "speed": ("velocidade", lambda torrent: torrent.dlspeed + torrent.upspeed, True),
+    "eta": ("ETA", lambda torrent: torrent.eta, False),
+    "ratio": ("ratio", lambda torrent: torrent.ratio, True),
+}
+
+def snapshot_age():
+    synced = [instance.sync.synced_at for instance in qb_instances.values() if instance.sync.synced_at]
+    return time.time() - min(synced) if synced else None
+
+def query_lines(torrents, title, extra=None):
+    # Cabeçalho, uma linha por torrent (com a instância, numa frota) e o aviso de corte
+    fleet = len(qb_instances) > 1
+    lines = [title]
+    for torrent in torrents[:QUERY_MAX_RESULTS]:
+        line = format_torrent_line(torrent, extra(torrent) if extra else "")
+        lines.append(f"[{torrent.instance}] {line}" if fleet else line)
+    if len(torrents) > QUERY_MAX_RESULTS:
+        lines.append(f"... e mais {len(torrents) - QUERY_MAX_RESULTS}")
+    return lines
+
+async def reply_lines(update, lines):
+    for text in split_message(lines):
+        await update.message.reply_text(text)
+
+async def reply_if_no_snapshot(update):
+    if snapshot_age() is None:
+        await update.message.reply_text("Ainda não há dados do monitor. Use /start.")
+        return True
+    return False
+
+# Função que trata o comando /status: resumo de cada instância
+async def status_command(update: Update, context: CallbackContext):
+    if await reply_if_no_snapshot(update):
+        return
+    lines = []
+    for instance in qb_instances.values():
+        torrents = instance.sync.torrents.values()
+        if instance.sync.synced_at is None:
+            lines.append(f"{instance.name}: sem dados")
+            continue
+        states = defaultdict(int)
+        for torrent in torrents:
+            states["baixando" if torrent.state in DOWNLOAD_STATES else
+                   "semeando" if torrent.upspeed > 0 else
+                   "concluídos" if torrent.progress >= 1.0 else "outros"] += 1
+        free_space_gb = get_free_space_from_qbittorrent(instance.sync.server_state)
+        free = f"{free_space_gb:.2f}GB" if isinstance(free_space_gb, float) else free_space_gb
+        lines.append(
+            f"{instance.name}: {len(instance.sync.torrents)} torrents | "
+            + " | ".join(f"{state}: {count}" for state, count in sorted(states.items()))
+        )
+        lines.append(
+            f"  DL: {sum(t.dlspeed for t in torrents) / (1024 ** 2):.2f} MB/s"
+            f" | UL: {sum(t.upspeed for t in torrents) / (1024 ** 2):.2f} MB/s | FREE: {free}"
+            f" | dados de {time.time() - instance.sync.synced_at:.0f}s atrás"
+        )
+    lines.append(upload_queue.describe()[0])
+    await reply_lines(update, lines)
+
+# Função que trata o comando /top speed|eta|ratio [N]. A seleção usa heap (O(n log N)), sem
+# ordenar a frota inteira.
+async def top_command(update: Update, context: CallbackContext):
+    args = context.args or []
+    order = args[0].lower() if args else "speed"
+    try:
+        count = int(args[1]) if len(args) > 1 else TOP_DEFAULT
+    except ValueError:
+        count = 0
+    if order not in TOP_ORDERS or count < 1:
+        await update.message.reply_text("Uso: /top speed|eta|ratio [N]")
+        return
+    if await reply_if_no_snapshot(update):
+        return
+    count = min(count, QUERY_MAX_RESULTS)
+    label, key, largest = TOP_ORDERS[order]
+    torrents = fleet_torrents()
+    if order == "eta":
+        # Só downloads com previsão de término; 8640000 é o "infinito" do qBit
+        torrents = (torrent for torrent in torrents if torrent.progress < 1.0 and 0 < torrent.eta < 8640000)
+    select = heapq.nlargest if largest else heapq.nsmallest
+    top = select(count, torrents, key=key)
+    extra = (lambda torrent: f" | ratio {torrent.ratio:.2f}") if order == "ratio" else None
+    await reply_lines(update, query_lines(top, f"Top {len(top)} por {label}:", extra))
+
+# Função que trata o comando /find <texto>: busca por parte do nome, sem diferenciar maiúsculas
+async def find_command(update: Update, context: CallbackContext):
+    text = " ".join(context.args or []).strip()
+    if not text:
+        await update.message.reply_text("Uso: /find <parte do nome>")
+        return
+    if await reply_if_no_snapshot(update):
+        return
+    found = [
+        instance.sync.torrents[key]
+        for instance in qb_instances.values()
+        for key in instance.sync.index.find(text)
+        if key in instance.sync.torrents
+    ]
+    found.sort(key=lambda torrent: torrent.name.casefold())
+    await reply_lines(update, query_lines(found, f"{len(found)} torrent(s) com \"{text}\":"))
+
+# Função que trata o comando /tag <tag>; sem argumento, lista as tags com a contagem
+async def tag_command(update: Update, context: CallbackContext):
+    if await reply_if_no_snapshot(update):
+        return
+    tag = " ".join(context.args or []).strip()
+    if not tag:
+        counts = defaultdict(int)
+        for instance in qb_instances.values():
+            for name, keys in instance.sync.index.tags.items():
+                counts[name] += len(keys)
+        lines = ["Tags:"] + [f"{name}: {count}" for name, count in sorted(counts.items())]
+        await reply_lines(update, lines if counts else ["Nenhum torrent com tag."])
+        return
+    tagged = [
+        instance.sync.torrents[key]
+        for instance in qb_instances.values()
+        for key in instance.sync.index.tagged(tag)
+        if key in instance.sync.torrents
+    ]
+    tagged.sort(key=lambda torrent: torrent.name.casefold())
+    await reply_lines(update, query_lines(tagged, f"{len(tagged)} torrent(s) com a tag \"{tag}\":"))
+
+# Controle em lote: /pause, /resume, /recheck, /delete e /setlimit recebem filtros, resolvidos
+# na tabela local, e fazem uma única chamada por instância com a lista de hashes (hashes=a|b|c),
+# não importa quantos torrents casem. Sem filtro o comando é recusado.
+#   state=downloading,stalledUP  tag=movies  category=tv  name=*ubuntu*  ratio>=2  instance=seedbox1
+# Valores separados por vírgula valem como "ou"; filtros diferentes precisam casar todos.
+STATE_GROUPS = {
+    "downloading": set(DOWNLOAD_STATES) | {"forcedDL", "stalledDL", "metaDL", "forcedMetaDL"},
+    "completed": COMPLETED_STATES,
+    "seeding": {"uploading", "stalledUP", "forcedUP", "queuedUP"},
+    "paused": {"stoppedDL", "stoppedUP", "pausedDL", "pausedUP"},
+    "stopped": {"stoppedDL", "stoppedUP", "pausedDL", "pausedUP"},
+    "stalled": {"stalledDL", "stalledUP"},
+    "errored": {"error", "missingFiles"},
+}
+FILTER_RE = re.compile(r"^(state|tag|category|name|ratio|instance)(>=|<=|=|>|<)(.+)$", re.IGNORECASE)
+RATIO_COMPARISONS = {
+    ">=": lambda ratio, limit: ratio >= limit,
+    "<=": lambda ratio, limit: ratio <= limit,
+    ">": lambda ratio, limit: ratio > limit,
+    "<": lambda ratio, limit: ratio < limit,
+    "=": lambda ratio, limit: abs(ratio - limit) < 0.005,
+}
+# Ação: (método do qbittorrentapi, resultado, opções aceitas além dos filtros, uso)
+BULK_ACTIONS = {
+    "pause": ("torrents_stop", "pausados", (), "/pause <filtros>"),
+    "resume": ("torrents_start", "retomados", (), "/resume <filtros>"),
+    "recheck": ("torrents_recheck", "verificados de novo", (), "/recheck <filtros>"),
+    "delete": ("torrents_delete", "removidos", ("files", "confirm"), "/delete [files=yes] [confirm=yes] <filtros>"),
+    "setlimit": (None, "com limite alterado", ("dl", "ul"), "/setlimit dl=<MB/s> ul=<MB/s> <filtros>"),
+}
+
+# Converte os argumentos do comando em um predicado. Retorna (predicado, opções, erro); as
+# opções são os argumentos nome=valor que não são filtros (como dl= e ul= do /setlimit).
+def parse_filters(args, options=()):
+    checks, values = [], {}
+    for arg in args:
+        name, _, value = arg.partition("=")
+        if name.lower() in options and value:
+            values[name.lower()] = value
+            continue
+        match = FILTER_RE.match(arg)
+        if match is None:
+            return None, values, f"Filtro inválido: {arg}"
+        field, operator, value = match.group(1).lower(), match.group(2), match.group(3)
+        if field == "ratio":
+            try:
+                limit = float(value)
+            except ValueError:
+                return None, values, f"Ratio inválido: {value}"
+            compare = RATIO_COMPARISONS[operator]
+            checks.append(lambda torrent, compare=compare, limit=limit: compare(torrent.ratio, limit))
+            continue
+        if operator != "=":
+            return None, values, f"O filtro {field} só aceita '='"
+        wanted = [item.strip() for item in value.split(",") if item.strip()]
+        if field == "state":
+            states = set()
+            for item in wanted:
+                states |= STATE_GROUPS.get(item.lower(), {item})
+            checks.append(lambda torrent, states=states: torrent.state in states)
+        elif field == "tag":
+            tags = parse_tags(value)
+            checks.append(lambda torrent, tags=tags: not tags.isdisjoint(parse_tags(torrent.tags)))
+        elif field == "category":
+            checks.append(lambda torrent, wanted=wanted: torrent.category in wanted)
+        elif field == "instance":
+            checks.append(lambda torrent, wanted=wanted: torrent.instance in wanted)
+        else:
+            # Sem curinga, o padrão vale como parte do nome
+            patterns = [item.casefold() if any(c in item for c in "*?[") else f"*{item.casefold()}*" for item in wanted]
+            checks.append(lambda torrent, patterns=patterns: any(
+                fnmatch.fnmatchcase(torrent.name.casefold(), pattern) for pattern in patterns))
+    if not checks:
+        return None, values, "Informe ao menos um filtro (state=, tag=, category=, name=, ratio>=, instance=)."
+    return (lambda torrent: all(check(torrent) for check in checks)), values, None
+
+# Hashes que casam com o filtro, agrupados por instância
+def select_hashes(predicate):
+    selected = {}
+    for instance in qb_instances.values():
+        hashes = [torrent.hash for torrent in instance.sync.torrents.values() if predicate(torrent)]
+        if hashes:
+            selected[instance] = hashes
+    return selected
+
+# Limite em MB/s do /setlimit para bytes/s; 0 remove o limite
+def parse_limit(value):
+    if value is None:
+        return None
+    limit = float(value)
+    if limit < 0:
+        raise ValueError(value)
+    return int(limit * 1024 ** 2)
+
+YES_VALUES = ("1", "true", "yes", "sim")
+
+# O /delete primeiro mostra o que vai ser removido e só age pelo botão de confirmação (ou com
+# confirm=yes). A confirmação guarda os hashes da prévia e vale só para quem pediu.
+PendingDelete = namedtuple("PendingDelete", ["user_id", "selected", "delete_files", "expires"])
+DELETE_CONFIRM_TIMEOUT = 120
+DELETE_PREVIEW_NAMES = 10
+pending_deletes = {}
+
+async def bulk_command(update: Update, context: CallbackContext, action):
+    # Ações em lote exigem a lista explícita de administradores; o chat sozinho não basta
+    if not ADMIN_USER_IDS:
+        await update.message.reply_text("O controle em lote exige ADMIN_USER_IDS definido.")
+        return
+    if not is_admin(update):
+        await update.message.reply_text("Comando restrito aos administradores.")
+        return
+    method, done, options, usage = BULK_ACTIONS[action]
+    predicate, values, error = parse_filters(context.args or [], options)
+    if action == "setlimit" and not error and not ("dl" in values or "ul" in values):
+        error = "Informe dl=<MB/s> e/ou ul=<MB/s> (0 remove o limite)."
+    if error:
+        await update.message.reply_text(f"{error}\nUso: {usage}")
+        return
+    if await reply_if_no_snapshot(update):
+        return
+    try:
+        dl_limit, ul_limit = parse_limit(values.get("dl")), parse_limit(values.get("ul"))
+    except ValueError:
+        await update.message.reply_text("Limite inválido: use MB/s, 0 remove o limite.")
+        return
+
+    selected = select_hashes(predicate)
+    if not selected:
+        await update.message.reply_text("Nenhum torrent casa com o filtro.")
+        return
+
+    delete_files = values.get("files", "").lower() in YES_VALUES
+    if action == "delete" and values.get("confirm", "").lower() not in YES_VALUES:
+        await preview_delete(update, selected, delete_files)
+        return
+    await reply_lines(update, await apply_bulk(action, selected, delete_files, dl_limit, ul_limit))
+
+async def apply_bulk(action, selected, delete_files=False, dl_limit=None, ul_limit=None):
+    method, done, _, _ = BULK_ACTIONS[action]
+    lines, total = [], 0
+    for instance, hashes in selected.items():
+        if instance.qbt is None:
+            lines.append(f"{instance.name}: sem conexão, {len(hashes)} torrent(s) ignorado(s)")
+            continue
+        try:
+            # Uma chamada por ação e instância, com todos os hashes no mesmo pedido
+            if action == "setlimit":
+                if dl_limit is not None:
+                    await instance.qbt.call("torrents_set_download_limit", limit=dl_limit, torrent_hashes=hashes)
+                if ul_limit is not None:
+                    await instance.qbt.call("torrents_set_upload_limit", limit=ul_limit, torrent_hashes=hashes)
+            elif action == "delete":
+                await instance.qbt.call(method, delete_files=delete_files, torrent_hashes=hashes)
+            else:
+                await instance.qbt.call(method, torrent_hashes=hashes)
+        except Exception as e:
+            logger.warning("Erro ao aplicar /%s em '%s': %s", action, instance.name, str(e) or type(e).__name__)
+            lines.append(f"{instance.name}: erro, {len(hashes)} torrent(s) não alterado(s)")
+            continue
+        total += len(hashes)
+        if len(qb_instances) > 1:
+            lines.append(f"{instance.name}: {len(hashes)}")
+    logger.info("/%s aplicado a %s torrent(s).", action, total)
+    return [f"{total} torrent(s) {done}."] + lines
+
+async def preview_delete(update, selected, delete_files):
+    now = time.time()
+    for token in [token for token, pending in pending_deletes.items() if pending.expires < now]:
+        del pending_deletes[token]
+    token = secrets.token_hex(8)
+    pending_deletes[token] = PendingDelete(
+        update.effective_user.id, selected, delete_files, now + DELETE_CONFIRM_TIMEOUT
+    )
+
+    names = [
+        instance.sync.torrents[instance.sync.key(torrent_hash)].name
+        for instance, hashes in selected.items()
+        for torrent_hash in hashes
+        if instance.sync.key(torrent_hash) in instance.sync.torrents
+    ]
+    count = sum(len(hashes) for hashes in selected.values())
+    lines = [f"{count} torrent(s) serão removidos{' COM OS ARQUIVOS' if delete_files else ''}:"]
+    lines.extend(f"• {name[:DASHBOARD_NAME_WIDTH * 2]}" for name in sorted(names)[:DELETE_PREVIEW_NAMES])
+    if count > DELETE_PREVIEW_NAMES:
+        lines.append(f"... e mais {count - DELETE_PREVIEW_NAMES}")
+    lines.append(f"Confirme em até {DELETE_CONFIRM_TIMEOUT // 60} min.")
+    markup = InlineKeyboardMarkup([[
+        InlineKeyboardButton("Confirmar remoção", callback_data=f"bulk:{token}:confirm"),
+        InlineKeyboardButton("Cancelar", callback_data=f"bulk:{token}:cancel"),
+    ]])
+    await update.message.reply_text("\n".join(lines), reply_markup=markup)
+
+# Função que trata os botões de confirmação do /delete
+async def bulk_callback(update: Update, context: CallbackContext):
+    query = update.callback_query
+    _, token, choice = query.data.split(":", 2)
+    pending = pending_deletes.get(token)
+    if pending is None:
+        # Já confirmada, cancelada ou esquecida num reinício
+        await query.answer("Esta confirmação não vale mais.")
+        return
+    if pending.expires < time.time():
+        del pending_deletes[token]
+        await query.answer("Confirmação expirada.")
+        await query.edit_message_text("Remoção não confirmada a tempo. Rode o /delete de novo.")
+        return
+    if update.effective_user is None or update.effective_user.id != pending.user_id or not is_admin(update):
+        await query.answer("Só quem pediu a remoção pode confirmar.")
+        return
+    del pending_deletes[token]
+    await query.answer()
+    if choice != "confirm":
+        await query.edit_message_text("Remoção cancelada.")
+        return
+    lines = await apply_bulk("delete", pending.selected, pending.delete_files)
+    await query.edit_message_text("\n".join(lines)[:4096])
+
+# Funções que tratam os comandos de controle em lote
+async def pause_command(update: Update, context: CallbackContext):
+    await bulk_command(update, context, "pause")
+
+async def resume_command(update: Update, context: CallbackContext):
+    await bulk_command(update, context, "resume")
+
+async def recheck_command(update: Update, context: CallbackContext):
+    await bulk_command(update, context, "recheck")
+
+async def delete_command(update: Update, context: CallbackContext):
+    await bulk_command(update, context, "delete")
+
+async def setlimit_command(update: Update, context: CallbackContext):
+    await bulk_command(update, context, "setlimit")
+
+# Servidor HTTP mínimo para os avisos do qBit: POST /torrent-finished com hash=<infohash> e,
+# numa frota, instance=<nome>. O envio começa na hora, sem esperar o próximo ciclo do monitor.
+class IngestServer:
+    MAX_BODY = 4096
+
+    def __init__(self, addr=INGEST_ADDR, port=INGEST_PORT, token=INGEST_TOKEN):
+        self.addr = addr
+        self.port = port
+        self.token = token
+        self.bot = None
+        self.server = None
+
+    async def start(self, bot):
+        self.bot = bot
+        self.server = await asyncio.start_server(self.handle, self.addr, self.port)
+        logger.info("Recebendo avisos de torrent concluído em http://%s:%s/torrent-finished", self.addr, self.port)
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        try:
+            status, text = await asyncio.wait_for(self.respond(reader), 10)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError, ConnectionError):
+            status, text = 400, "requisição inválida"
+        except Exception as e:
+            # Toda requisição recebe resposta, mesmo quando algo dá errado do nosso lado
+            logger.exception("Erro ao tratar aviso de torrent concluído: %s", e)
+            status, text = 500, "erro interno"
+        body = text.encode()
+        writer.write(
+            f"HTTP/1.1 {status} {'OK' if status < 400 else 'Error'}\r\nContent-Type: text/plain; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, reader):
+        method, target, _ = (await reader.readline()).decode("latin-1").split(" ", 2)
+        headers = {}
+        while (line := (await reader.readline()).decode("latin-1").strip()):
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        length = min(int(headers.get("content-length") or 0), self.MAX_BODY)
+        body = (await reader.readexactly(length)).decode() if length else ""
+
+        url = urlsplit(target)
+        if method != "POST" or url.path != "/torrent-finished":
+            return 404, "não encontrado"
+        fields = dict(parse_qsl(url.query))
+        if body:
+            data = (json.loads(body) if headers.get("content-type", "").startswith("application/json")
+                    else dict(parse_qsl(body)))
+            # O JSON precisa ser um objeto só com textos, como os campos de um formulário
+            if not isinstance(data, dict) or not all(isinstance(value, str) for value in data.values()):
+                INGEST_EVENTS.labels("invalid").inc()
+                return 400, "campos inválidos"
+            fields.update(data)
+        token = headers.get("x-ingest-token") or fields.get("token", "")
+        if self.token and not hmac.compare_digest(token.encode(), self.token.encode()):
+            INGEST_EVENTS.labels("unauthorized").inc()
+            return 403, "token inválido"
+        torrent_hash = fields.get("hash", "").strip().lower()
+        if not re.fullmatch(r"[0-9a-f]{40}|[0-9a-f]{64}", torrent_hash):
+            INGEST_EVENTS.labels("invalid").inc()
+            return 400, "hash inválido"
+
+        result = await ingest_finished(self.bot, torrent_hash, fields.get("instance"))
+        INGEST_EVENTS.labels(result).inc()
+        return (202 if result in ("queued", "pending") else 404 if result == "unknown" else 503), result
+
+ingest_server = IngestServer()
+
+# Consulta o torrent avisado direto no qBit e, se o download terminou, coloca na fila de envio.
+# Sem o nome da instância, pergunta a todas as conectadas.
+async def ingest_finished(bot, torrent_hash, instance_name=None):
+    if instance_name:
+        candidates = [qb_instances[instance_name]] if instance_name in qb_instances else []
+    else:
+        candidates = list(qb_instances.values())
+    candidates = [instance for instance in candidates if instance.qbt is not None]
+    if not candidates:
+        return "not_monitoring"
+    for instance in candidates:
+        try:
+            info = await instance.qbt.call("torrents_info", torrent_hashes=torrent_hash)
+        except Exception as e:
+            logger.warning("Erro ao consultar '%s' no qBittorrent '%s': %s", torrent_hash, instance.name, e)
+            continue
+        if info:
+            logger.info("Aviso de torrent concluído para '%s' em '%s'.", info[0].name, instance.name)
+            # Se o qBit ainda não terminou de mover ou checar os arquivos, o monitor pega depois
+            return "queued" if enqueue_if_completed(bot, instance.sync.key(torrent_hash), info[0]) else "pending"
+    return "unknown"
+
+# Inicializações que dependem do loop de eventos do bot
+async def post_init(application):
+    if INGEST_PORT:
+        await ingest_server.start(application.bot)
+
+async def post_shutdown(application):
+    await ingest_server.stop()
+
+# Comandos administrativos só respondem a ADMIN_USER_IDS (ou ao chat do bot, sem a lista)
+def is_admin(update):
+    if ADMIN_USER_IDS:
+        return update.effective_user is not None and update.effective_user.id in ADMIN_USER_IDS
+    return update.effective_chat is not None and str(update.effective_chat.id) == str(CHAT_ID)
+
+# Detecta travamentos do loop de eventos: uma tarefa do loop atualiza um batimento e uma
+# thread separada, quando o batimento atrasa mais que o limite, guarda a pilha do loop naquele
+# instante, que mostra exatamente o código que está segurando o loop
+class LoopWatchdog:
+    def __init__(self, threshold=LOOP_BLOCK_THRESHOLD):
+        self.threshold = threshold
+        self.interval = min(0.05, threshold / 4)
+        self.blocks = []
+        self.beat = time.monotonic()
+        self._stopped = threading.Event()
+        self._loop_thread = threading.get_ident()
+
+    async def run(self):
+        thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        thread.start()
+        try:
+            while True:
+                self.beat = time.monotonic()
+                await asyncio.sleep(self.interval)
+        finally:
+            self._stopped.set()
+
+    def _watch(self):
+        current = None
+        while not self._stopped.wait(self.interval):
+            lag = time.monotonic() - self.beat - self.interval
+            if lag < self.threshold:
+                current = None
+                continue
+            if current is None:
+                frame = sys._current_frames().get(self._loop_thread)
+                current = {"lag": lag, "stack": traceback.format_stack(frame) if frame else []}
+                self.blocks.append(current)
+                logger.warning("Loop de eventos travado há %.2fs", lag)
+            current["lag"] = max(current["lag"], lag)
+
+    def describe(self, limit=3):
+        lines = [f"Travamentos do loop acima de {self.threshold:.2f}s: {len(self.blocks)}"]
+        for block in sorted(self.blocks, key=lambda block: block["lag"], reverse=True)[:limit]:
+            lines.append(f"\n{block['lag']:.2f}s em:")
+            lines.extend(line.rstrip() for line in block["stack"][-4:])
+        return lines
+
+profile_running = False
+
+# Função que trata o comando /profile <segundos>: perfila o loop de eventos (monitor, fila do
+# Telegram, envios e comandos) durante a janela e responde com o resumo e o arquivo .pstats
+async def profile_command(update: Update, context: CallbackContext):
+    global profile_running
+    if not is_admin(update):
+        await update.message.reply_text("Comando restrito aos administradores.")
+        return
+    try:
+        seconds = int(context.args[0]) if context.args else PROFILE_DEFAULT_SECONDS
+    except ValueError:
+        await update.message.reply_text("Uso: /profile <segundos>")
+        return
+    seconds = max(1, min(seconds, PROFILE_MAX_SECONDS))
+    if profile_running:
+        await update.message.reply_text("Já existe um perfilamento em andamento.")
+        return
+
+    profile_running = True
+    watchdog = LoopWatchdog()
+    watchdog_task = asyncio.create_task(watchdog.run())
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError as e:
+        # Outro profiler já está ativo neste processo
+        watchdog_task.cancel()
+        profile_running = False
+        await update.message.reply_text(f"Não foi possível iniciar o perfilamento: {e}")
+        return
+    await update.message.reply_text(f"Perfilando por {seconds}s...")
+    try:
+        await asyncio.sleep(seconds)
     finally:
-        # Remove arquivos temporários
-        shutil.rmtree(temp_folder, ignore_errors=True)
-        if part_pattern:  # Verificar se part_pattern foi definido
-            for part_file in glob.glob(part_pattern):
-                os.remove(part_file)
+        profiler.disable()
+        watchdog_task.cancel()
+        profile_running = False
+
+    stats = pstats.Stats(profiler).sort_stats(pstats.SortKey.CUMULATIVE)
+    lines = [f"Perfil de {seconds}s: {stats.total_calls} chamadas, {stats.total_tt:.2f}s medidos no loop"]
+    lines.extend(watchdog.describe())
+    lines.append("\nMais caras (acumulado | próprio | chamadas):")
+    for func in stats.fcn_list[:15]:
+        _, calls, own, cumulative, _ = stats.stats[func]
+        if not pstats.func_std_string(func):
+            continue
+        lines.append(f"{cumulative:.3f}s | {own:.3f}s | {calls} | {pstats.func_std_string(func)[-120:]}")
+    for text in split_message(lines):
+        await update.message.reply_text(text)
+
+    with tempfile.NamedTemporaryFile(suffix=".pstats") as dump:
+        stats.dump_stats(dump.name)
+        dump.seek(0)
+        await update.message.reply_document(
+            InputFile(dump, filename=time.strftime("profile-%Y%m%d-%H%M%S.pstats")),
+            caption="Abra com: python -m pstats <arquivo> ou snakeviz",
+        )
 
 # Função principal que configura e inicia o bot
 def main():
-    application = Application.builder().token(BOT_TOKEN).build()
+    if METRICS_PORT:
+        start_http_server(METRICS_PORT, addr=METRICS_ADDR)
+        logger.info("Métricas em http://%s:%s/metrics", METRICS_ADDR, METRICS_PORT)
+    builder = Application.builder().token(BOT_TOKEN)
+    if TELEGRAM_API_BASE_URL:
+        # Permite apontar o bot para um servidor local da Bot API (ou para o simulador em bench/)
+        builder = builder.base_url(f"{TELEGRAM_API_BASE_URL}/bot").base_file_url(f"{TELEGRAM_API_BASE_URL}/file/bot")
+    application = (
+        builder.concurrent_updates(CONCURRENT_UPDATES).post_init(post_init).post_shutdown(post_shutdown).build()
+    )
     application.add_handler(CommandHandler("start", start_download))
-    application.run_polling()
-    print("Bot iniciado.")
+    application.add_handler(CommandHandler("queue", show_queue))
+    application.add_handler(CommandHandler("status", status_command))
+    application.add_handler(CommandHandler("top", top_command))
+    application.add_handler(CommandHandler("find", find_command))
+    application.add_handler(CommandHandler("tag", tag_command))
+    application.add_handler(CommandHandler("pause", pause_command))
+    application.add_handler(CommandHandler("resume", resume_command))
+    application.add_handler(CommandHandler("recheck", recheck_command))
+    application.add_handler(CommandHandler("delete", delete_command))
+    application.add_handler(CommandHandler("setlimit", setlimit_command))
+    # block=False: a janela de perfilamento não pode segurar os outros comandos
+    application.add_handler(CommandHandler("profile", profile_command, block=False))
+    application.add_handler(CallbackQueryHandler(dashboard_callback, pattern=r"^dash:"))
+    application.add_handler(CallbackQueryHandler(bulk_callback, pattern=r"^bulk:"))
+
+    # O bot só usa comandos e botões; o Telegram não precisa mandar outros tipos de atualização
+    allowed_updates = [Update.MESSAGE, Update.CALLBACK_QUERY]
+    if TELEGRAM_MODE == "webhook" and WEBHOOK_URL:
+        # O python-telegram-bot recusa com 403 as requisições sem o X-Telegram-Bot-Api-Secret-Token certo
+        logger.info("Recebendo atualizações por webhook em %s:%s/%s", WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH)
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            cert=WEBHOOK_CERT,
+            key=WEBHOOK_KEY,
+            allowed_updates=allowed_updates,
+        )
+    else:
+        if TELEGRAM_MODE == "webhook":
+            logger.error("TELEGRAM_MODE=webhook exige WEBHOOK_URL; usando long polling.")
+        application.run_polling(allowed_updates=allowed_updates)
+    logger.info("Bot iniciado.")
 
 if __name__ == "__main__":
-    print("Python iniciado.")
+    logger.info("Python iniciado.")
     main()
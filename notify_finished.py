@@ -0,0 +1,62 @@
+# Avisa o bot que um torrent terminou de baixar, para o envio começar na hora.
+#
+# No qBittorrent: Opções > Downloads > "Executar programa externo ao concluir o torrent":
+#   python3 /caminho/para/notify_finished.py "%I"
+# Numa frota, cada nó informa o próprio nome (o mesmo usado em QB_INSTANCES):
+#   python3 /caminho/para/notify_finished.py "%I" --instance seedbox1
+#
+# Lê INGEST_URL (ou INGEST_ADDR/INGEST_PORT) e INGEST_TOKEN do ambiente ou do .env ao lado.
+# Usa só a biblioteca padrão e nunca falha com erro, para não atrapalhar o qBit.
+import argparse
+import os
+import sys
+import urllib.error
+import urllib.parse
+import urllib.request
+
+
+def load_env_file(path):
+    # Leitura simples do .env, sem depender do python-dotenv no ambiente do qBit
+    values = {}
+    try:
+        with open(path, encoding="utf-8") as env_file:
+            for line in env_file:
+                name, sep, value = line.strip().partition("=")
+                if sep and not name.startswith("#"):
+                    values[name.strip()] = value.strip().strip('"').strip("'")
+    except OSError:
+        pass
+    return values
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Avisa o bot que um torrent foi concluído")
+    parser.add_argument("hash", help="infohash do torrent (%%I no qBittorrent)")
+    parser.add_argument("--instance", default="", help="nome da instância do qBit na frota")
+    parser.add_argument("--timeout", type=float, default=5.0)
+    args = parser.parse_args()
+
+    env = load_env_file(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".env"))
+    env.update(os.environ)
+    url = env.get("INGEST_URL") or (
+        f"http://{env.get('INGEST_ADDR') or '127.0.0.1'}:{env.get('INGEST_PORT') or '8765'}/torrent-finished"
+    )
+    fields = {"hash": args.hash}
+    if args.instance:
+        fields["instance"] = args.instance
+    request = urllib.request.Request(url, data=urllib.parse.urlencode(fields).encode(), method="POST")
+    if env.get("INGEST_TOKEN"):
+        request.add_header("X-Ingest-Token", env["INGEST_TOKEN"])
+
+    try:
+        with urllib.request.urlopen(request, timeout=args.timeout) as response:
+            print(response.read().decode(errors="replace"))
+    except urllib.error.HTTPError as e:
+        print(f"Bot respondeu {e.code}: {e.read().decode(errors='replace')}", file=sys.stderr)
+    except (urllib.error.URLError, OSError) as e:
+        # Bot fora do ar: o monitor encontra o torrent concluído no próximo ciclo
+        print(f"Bot indisponível: {e}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()